@@ -1,5 +1,10 @@
 # Reference:
 # https://nvlpubs.nist.gov/nistpubs/FIPS/NIST.FIPS.197-upd1.pdf
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+from typing import NamedTuple, Optional
 
 # The block ciphers AES-128, AES-192 and AES-256 differ in 3 aspects
 # 1) Length of key
@@ -251,33 +256,443 @@ def inv_cipher(input: list[int], nr: int, w: list[list[int]]):
     return state
 
 
-# fmt: off
-key = [
-    0x2B, 0x7E, 0x15, 0x16, 0x28, 0xAE, 0xD2, 0xA6, 0xAB, 0xF7, 0x15, 0x88, 0x09, 0xCF, 0x4F, 0x3C
-]
-input = [
-    0x74, 0x61, 0x6E, 0x75, 0x73, 0x68, 0x72, 0x65, 0x65, 0x73, 0x74, 0x72, 0x77, 0x62, 0x72, 0x79
-]
-# fmt: on
-got = cipher(input, 10, key_expansion(key, 4, 10))
-want = [
-    [0xE1, 0x16, 0xA9, 0x35],
-    [0xC8, 0x04, 0xCD, 0x22],
-    [0x49, 0xA8, 0x6E, 0x90],
-    [0xEE, 0x9E, 0xBC, 0x44],
-]
-assert got == want
-
-output = [0 for _ in range(16)]
-for r in range(4):
-    for c in range(4):
-        output[r + 4 * c] = want[r][c]
+# The round transformations SubBytes(), ShiftRows() and MixColumns() can be
+# fused into table lookups on 32-bit column words. A column word packs the 4
+# bytes of a state column with row 0 in the most significant byte:
+#
+# word(c) = s[0, c] << 24 | s[1, c] << 16 | s[2, c] << 8 | s[3, c]
+#
+# For a byte b, the table t_0 holds the column that MixColumns() produces
+# from SBox(b) placed in row 0, that is [{02}•S, {01}•S, {01}•S, {03}•S].
+# The tables t_1, t_2 and t_3 hold the same columns for rows 1, 2 and 3,
+# which are t_0 rotated right by 8, 16 and 24 bits. One round for column c
+# then becomes
+#
+# s'(c) = t_0[s[0, c]] ⊕ t_1[s[1, c + 1]] ⊕ t_2[s[2, c + 2]] ⊕ t_3[s[3, c + 3]] ⊕ w[4 * round + c]
+#
+# where the column offsets (mod 4) perform ShiftRows()
+s_box_flat = tuple(b for row in s_box for b in row)
+inv_s_box_flat = tuple(b for row in inv_s_box for b in row)
 
-decrypted = inv_cipher(output, 10, key_expansion(key, 4, 10))
 
-got = [0 for _ in range(16)]
-for r in range(4):
-    for c in range(4):
-        got[r + 4 * c] = decrypted[r][c]
+def ror32(word: int, n: int) -> int:
+    return ((word >> n) | (word << (32 - n))) & 0xFFFFFFFF
+
+
+def make_t_tables(
+    box: tuple[int, ...], coefficients: tuple[int, int, int, int]
+) -> tuple[tuple[int, ...], ...]:
+    t0 = tuple(
+        gf_mul(b, coefficients[0]) << 24
+        | gf_mul(b, coefficients[1]) << 16
+        | gf_mul(b, coefficients[2]) << 8
+        | gf_mul(b, coefficients[3])
+        for b in box
+    )
+    return (t0,) + tuple(tuple(ror32(t, 8 * i) for t in t0) for i in range(1, 4))
+
+
+# The tables are built on first use rather than on import: round_key_words()
+# builds them, since the T-table functions need packed round keys, and other
+# modules reading aes.t_0 go through the module __getattr__()
+T_TABLES = ("t_0", "t_1", "t_2", "t_3", "inv_t_0", "inv_t_1", "inv_t_2", "inv_t_3")
+
+
+def build_t_tables() -> None:
+    global t_0, t_1, t_2, t_3, inv_t_0, inv_t_1, inv_t_2, inv_t_3
+    if "inv_t_3" in globals():
+        return
+    t_0, t_1, t_2, t_3 = make_t_tables(s_box_flat, (0x02, 0x01, 0x01, 0x03))
+    # The inverse tables hold the columns that InvMixColumns() produces from
+    # InvSBox(b), [{0e}•S', {09}•S', {0d}•S', {0b}•S']
+    inv_t_0, inv_t_1, inv_t_2, inv_t_3 = make_t_tables(
+        inv_s_box_flat, (0x0E, 0x09, 0x0D, 0x0B)
+    )
+
+
+def __getattr__(name: str):
+    if name in T_TABLES:
+        build_t_tables()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# The key schedule produced by KeyExpansion() is a list of 4-byte words,
+# these are packed into 32-bit ints in the same byte order as the columns.
+# The packed schedule is kept in a flat array of unsigned 32-bit ints
+def round_key_words(w: list[list[int]]) -> array:
+    build_t_tables()
+    return array("I", [a << 24 | b << 16 | c << 8 | d for (a, b, c, d) in w])
+
+
+def encrypt_words(
+    s0: int, s1: int, s2: int, s3: int, nr: int, rk: array
+) -> tuple[int, int, int, int]:
+    t0, t1, t2, t3 = t_0, t_1, t_2, t_3
+    s0 ^= rk[0]
+    s1 ^= rk[1]
+    s2 ^= rk[2]
+    s3 ^= rk[3]
+    # fmt: off
+    for k in range(4, 4 * nr, 4):
+        u0 = t0[s0 >> 24] ^ t1[s1 >> 16 & 0xFF] ^ t2[s2 >> 8 & 0xFF] ^ t3[s3 & 0xFF] ^ rk[k]
+        u1 = t0[s1 >> 24] ^ t1[s2 >> 16 & 0xFF] ^ t2[s3 >> 8 & 0xFF] ^ t3[s0 & 0xFF] ^ rk[k + 1]
+        u2 = t0[s2 >> 24] ^ t1[s3 >> 16 & 0xFF] ^ t2[s0 >> 8 & 0xFF] ^ t3[s1 & 0xFF] ^ rk[k + 2]
+        u3 = t0[s3 >> 24] ^ t1[s0 >> 16 & 0xFF] ^ t2[s1 >> 8 & 0xFF] ^ t3[s2 & 0xFF] ^ rk[k + 3]
+        s0, s1 = u0, u1
+        s2, s3 = u2, u3
+    # The last round has no MixColumns(), so only SubBytes() and ShiftRows()
+    # are applied with the S-box
+    s = s_box_flat
+    k = 4 * nr
+    return (
+        (s[s0 >> 24] << 24 | s[s1 >> 16 & 0xFF] << 16 | s[s2 >> 8 & 0xFF] << 8 | s[s3 & 0xFF]) ^ rk[k],
+        (s[s1 >> 24] << 24 | s[s2 >> 16 & 0xFF] << 16 | s[s3 >> 8 & 0xFF] << 8 | s[s0 & 0xFF]) ^ rk[k + 1],
+        (s[s2 >> 24] << 24 | s[s3 >> 16 & 0xFF] << 16 | s[s0 >> 8 & 0xFF] << 8 | s[s1 & 0xFF]) ^ rk[k + 2],
+        (s[s3 >> 24] << 24 | s[s0 >> 16 & 0xFF] << 16 | s[s1 >> 8 & 0xFF] << 8 | s[s2 & 0xFF]) ^ rk[k + 3],
+    )
+    # fmt: on
+
+
+def input_words(input: list[int]) -> tuple[int, ...]:
+    return tuple(
+        input[4 * c] << 24
+        | input[4 * c + 1] << 16
+        | input[4 * c + 2] << 8
+        | input[4 * c + 3]
+        for c in range(4)
+    )
+
+
+def words_state(words: tuple[int, ...]) -> list[list[int]]:
+    return [[(word >> (24 - 8 * r)) & 0xFF for word in words] for r in range(4)]
+
+
+# Same arguments and output as Cipher(), computed using the T-tables
+def t_cipher(input: list[int], nr: int, w: list[list[int]]):
+    return words_state(encrypt_words(*input_words(input), nr, round_key_words(w)))
+
 
-assert input == got
+# In the equivalent inverse cipher the order of InvSubBytes() and
+# InvShiftRows() is swapped, as is the order of AddRoundKey() and
+# InvMixColumns(). The latter requires the round keys of rounds 1 to nr - 1
+# to be modified by applying InvMixColumns() to them, which is done once when
+# the key is expanded:
+#
+# dw[i] = w[i] for 0 <= i < 4 * (nr + 1)
+# dw[4 * round : 4 * (round + 1)] = InvMixColumns(w[4 * round : 4 * (round + 1)])
+# for 1 <= round < nr
+#
+# This is the reference for inv_round_keys(), which expand_key() uses
+def eq_inv_key_expansion(w: list[list[int]], nr: int) -> list[list[int]]:
+    dw = [word.copy() for word in w]
+    for round in range(1, nr):
+        # Round key words are columns of the state
+        state = [[w[4 * round + c][r] for c in range(4)] for r in range(4)]
+        state = inv_mix_columns(state)
+        for c in range(4):
+            dw[4 * round + c] = [state[r][c] for r in range(4)]
+    return dw
+
+
+# The decryption round keys are packed in the order they are applied, that
+# is starting with the last round key
+def inv_round_key_words(dw: list[list[int]], nr: int) -> array:
+    return array(
+        "I",
+        [
+            word
+            for round in range(nr, -1, -1)
+            for word in round_key_words(dw[4 * round : 4 * (round + 1)])
+        ],
+    )
+
+
+# inv_round_key_words(eq_inv_key_expansion(w, nr), nr) computed from the
+# packed encryption round keys. InvMixColumns() of a word is a lookup of
+# each of its bytes in the inverse T-tables, which apply InvSubBytes() first,
+# so every byte goes through the S-box to cancel it
+def inv_round_keys(rk: array, nr: int) -> array:
+    build_t_tables()
+    s = s_box_flat
+    t0, t1, t2, t3 = inv_t_0, inv_t_1, inv_t_2, inv_t_3
+    dk = array("I", rk[4 * nr : 4 * nr + 4])
+    for k in range(4 * nr - 4, 0, -4):
+        # fmt: off
+        dk.extend(
+            t0[s[w >> 24]] ^ t1[s[w >> 16 & 0xFF]] ^ t2[s[w >> 8 & 0xFF]] ^ t3[s[w & 0xFF]]
+            for w in rk[k : k + 4]
+        )
+        # fmt: on
+    dk.extend(rk[0:4])
+    return dk
+
+
+def decrypt_words(
+    s0: int, s1: int, s2: int, s3: int, nr: int, dk: array
+) -> tuple[int, int, int, int]:
+    t0, t1, t2, t3 = inv_t_0, inv_t_1, inv_t_2, inv_t_3
+    s0 ^= dk[0]
+    s1 ^= dk[1]
+    s2 ^= dk[2]
+    s3 ^= dk[3]
+    # InvShiftRows() shifts the rows to the right, s'[r, c] = s[r, (c - r) mod 4]
+    # fmt: off
+    for k in range(4, 4 * nr, 4):
+        u0 = t0[s0 >> 24] ^ t1[s3 >> 16 & 0xFF] ^ t2[s2 >> 8 & 0xFF] ^ t3[s1 & 0xFF] ^ dk[k]
+        u1 = t0[s1 >> 24] ^ t1[s0 >> 16 & 0xFF] ^ t2[s3 >> 8 & 0xFF] ^ t3[s2 & 0xFF] ^ dk[k + 1]
+        u2 = t0[s2 >> 24] ^ t1[s1 >> 16 & 0xFF] ^ t2[s0 >> 8 & 0xFF] ^ t3[s3 & 0xFF] ^ dk[k + 2]
+        u3 = t0[s3 >> 24] ^ t1[s2 >> 16 & 0xFF] ^ t2[s1 >> 8 & 0xFF] ^ t3[s0 & 0xFF] ^ dk[k + 3]
+        s0, s1 = u0, u1
+        s2, s3 = u2, u3
+    s = inv_s_box_flat
+    k = 4 * nr
+    return (
+        (s[s0 >> 24] << 24 | s[s3 >> 16 & 0xFF] << 16 | s[s2 >> 8 & 0xFF] << 8 | s[s1 & 0xFF]) ^ dk[k],
+        (s[s1 >> 24] << 24 | s[s0 >> 16 & 0xFF] << 16 | s[s3 >> 8 & 0xFF] << 8 | s[s2 & 0xFF]) ^ dk[k + 1],
+        (s[s2 >> 24] << 24 | s[s1 >> 16 & 0xFF] << 16 | s[s0 >> 8 & 0xFF] << 8 | s[s3 & 0xFF]) ^ dk[k + 2],
+        (s[s3 >> 24] << 24 | s[s2 >> 16 & 0xFF] << 16 | s[s1 >> 8 & 0xFF] << 8 | s[s0 & 0xFF]) ^ dk[k + 3],
+    )
+    # fmt: on
+
+
+# Same arguments and output as InvCipher(), computed using the equivalent
+# inverse cipher and the inverse T-tables
+def t_inv_cipher(input: list[int], nr: int, w: list[list[int]]):
+    dk = inv_round_key_words(eq_inv_key_expansion(w, nr), nr)
+    return words_state(decrypt_words(*input_words(input), nr, dk))
+
+
+# A block of 16 bytes is read as 4 big-endian column words, since
+# in[r + 4c] = s[r, c] places the bytes of column c next to each other
+block_words = struct.Struct(">4I")
+
+
+def check_block(block: bytes) -> None:
+    if len(block) != 16:
+        raise ValueError(f"invalid AES block length: {len(block)} bytes")
+
+
+# Encrypts a 16-byte block with the round keys packed by round_key_words()
+def encrypt_block(block: bytes, nr: int, rk: array) -> bytes:
+    check_block(block)
+    return block_words.pack(*encrypt_words(*block_words.unpack(block), nr, rk))
+
+
+# Decrypts a 16-byte block with the round keys packed by inv_round_key_words()
+def decrypt_block(block: bytes, nr: int, dk: array) -> bytes:
+    check_block(block)
+    return block_words.pack(*decrypt_words(*block_words.unpack(block), nr, dk))
+
+
+# Encrypts or decrypts every block of src into dst, both being objects that
+# support the buffer protocol (bytes, bytearray, memoryview, mmap, NumPy
+# arrays). Blocks are read from and written to the buffers directly, and
+# since each block is read before it is written dst may be src. Returns the
+# number of bytes processed
+def crypt_into(dst, src, crypt_words, nr: int, rk: array) -> int:
+    with memoryview(src) as src_mv, memoryview(dst) as dst_mv:
+        if dst_mv.readonly:
+            raise TypeError("dst must be a writable buffer")
+        with src_mv.cast("B") as src_view, dst_mv.cast("B") as dst_view:
+            n = len(src_view)
+            if n % 16:
+                raise ValueError("src length must be a multiple of 16 bytes")
+            if len(dst_view) < n:
+                raise ValueError("dst is smaller than src")
+            unpack_from = block_words.unpack_from
+            pack_into = block_words.pack_into
+            for offset in range(0, n, 16):
+                words = crypt_words(*unpack_from(src_view, offset), nr, rk)
+                pack_into(dst_view, offset, *words)
+    return n
+
+
+# The number of rounds follows from the key length, nk = len(key) / 4 and
+# nr = nk + 6. Returns nr together with the packed encryption round keys and
+# the packed equivalent inverse cipher round keys
+def expand_key(key: bytes) -> tuple[int, array, array]:
+    if len(key) not in (16, 24, 32):
+        raise ValueError(f"invalid AES key length: {len(key)} bytes")
+    nk = len(key) // 4
+    nr = nk + 6
+    rk = round_key_words(key_expansion(list(key), nk, nr))
+    return nr, rk, inv_round_keys(rk, nr)
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    maxsize: int
+    currsize: int
+
+
+# Bounded LRU cache of expanded key schedules keyed by the key bytes, so a
+# key that is used repeatedly is only expanded once. It is safe to share
+# between threads. A maxsize of 0 disables caching, every get() expands the
+# key
+class KeyScheduleCache:
+    def __init__(self, maxsize: int = 4096):
+        if maxsize < 0:
+            raise ValueError(f"maxsize must not be negative: {maxsize}")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._schedules: OrderedDict[bytes, tuple[int, array, array]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: bytes) -> tuple[int, array, array]:
+        key = bytes(key)
+        with self._lock:
+            schedule = self._schedules.get(key)
+            if schedule is not None:
+                self._schedules.move_to_end(key)
+                self.hits += 1
+                return schedule
+            self.misses += 1
+        # Expanding the key does not need the lock, if 2 threads miss on the
+        # same key both results are identical and the later one is kept
+        schedule = expand_key(key)
+        if not self.maxsize:
+            return schedule
+        with self._lock:
+            self._schedules[key] = schedule
+            self._schedules.move_to_end(key)
+            while len(self._schedules) > self.maxsize:
+                self._schedules.popitem(last=False)
+                self.evictions += 1
+        return schedule
+
+    def cache_info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(
+                self.hits,
+                self.misses,
+                self.evictions,
+                self.maxsize,
+                len(self._schedules),
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._schedules.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+key_schedule_cache = KeyScheduleCache()
+
+
+# AES instance for a single key, the key schedules are expanded once (or
+# taken from the cache) and reused for every block
+class AES:
+    block_size = 16
+
+    def __init__(
+        self, key: bytes, cache: Optional[KeyScheduleCache] = key_schedule_cache
+    ):
+        if cache is None:
+            self.nr, self.rk, self.dk = expand_key(key)
+        else:
+            self.nr, self.rk, self.dk = cache.get(key)
+
+    def encrypt_block(self, block: bytes) -> bytes:
+        check_block(block)
+        return block_words.pack(
+            *encrypt_words(*block_words.unpack(block), self.nr, self.rk)
+        )
+
+    def decrypt_block(self, block: bytes) -> bytes:
+        check_block(block)
+        return block_words.pack(
+            *decrypt_words(*block_words.unpack(block), self.nr, self.dk)
+        )
+
+    def encrypt_into(self, dst, src) -> int:
+        return crypt_into(dst, src, encrypt_words, self.nr, self.rk)
+
+    def decrypt_into(self, dst, src) -> int:
+        return crypt_into(dst, src, decrypt_words, self.nr, self.dk)
+
+
+# Known-answer tests of the reference functions and of the T-table engine,
+# run with python -m aes
+def selftest() -> None:
+    # fmt: off
+    key = [
+        0x2B, 0x7E, 0x15, 0x16, 0x28, 0xAE, 0xD2, 0xA6, 0xAB, 0xF7, 0x15, 0x88, 0x09, 0xCF, 0x4F, 0x3C
+    ]
+    input = [
+        0x74, 0x61, 0x6E, 0x75, 0x73, 0x68, 0x72, 0x65, 0x65, 0x73, 0x74, 0x72, 0x77, 0x62, 0x72, 0x79
+    ]
+    # fmt: on
+    got = cipher(input, 10, key_expansion(key, 4, 10))
+    want = [
+        [0xE1, 0x16, 0xA9, 0x35],
+        [0xC8, 0x04, 0xCD, 0x22],
+        [0x49, 0xA8, 0x6E, 0x90],
+        [0xEE, 0x9E, 0xBC, 0x44],
+    ]
+    assert got == want
+    assert t_cipher(input, 10, key_expansion(key, 4, 10)) == want
+
+    output = [0 for _ in range(16)]
+    for r in range(4):
+        for c in range(4):
+            output[r + 4 * c] = want[r][c]
+
+    decrypted = inv_cipher(output, 10, key_expansion(key, 4, 10))
+
+    got = [0 for _ in range(16)]
+    for r in range(4):
+        for c in range(4):
+            got[r + 4 * c] = decrypted[r][c]
+
+    assert input == got
+    assert t_inv_cipher(output, 10, key_expansion(key, 4, 10)) == decrypted
+
+    w = key_expansion(key, 4, 10)
+    encrypted = encrypt_block(bytes(input), 10, round_key_words(w))
+    assert encrypted == bytes(output)
+    dk = inv_round_key_words(eq_inv_key_expansion(w, 10), 10)
+    for nk in (4, 6, 8):
+        schedule = key_expansion(list(range(4 * nk)), nk, nk + 6)
+        reference = inv_round_key_words(eq_inv_key_expansion(schedule, nk + 6), nk + 6)
+        assert inv_round_keys(round_key_words(schedule), nk + 6) == reference
+        assert expand_key(bytes(range(4 * nk)))[2] == reference
+    assert decrypt_block(encrypted, 10, dk) == bytes(input)
+    for crypt, keys in ((encrypt_block, round_key_words(w)), (decrypt_block, dk)):
+        try:
+            crypt(bytes(15), 10, keys)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("a 15-byte block was accepted")
+
+    block_cipher = AES(bytes(key), cache=None)
+    assert block_cipher.encrypt_block(bytes(input)) == encrypted
+    assert block_cipher.decrypt_block(encrypted) == bytes(input)
+
+    buffer = bytearray(input)
+    block_cipher.encrypt_into(buffer, buffer)
+    assert buffer == encrypted
+    block_cipher.decrypt_into(buffer, buffer)
+    assert buffer == bytes(input)
+    for crypt in (block_cipher.encrypt_block, block_cipher.decrypt_block):
+        try:
+            crypt(bytes(17))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("a 17-byte block was accepted")
+
+    # A cache of size 0 expands the key on every call and stores nothing
+    cache = KeyScheduleCache(0)
+    assert AES(bytes(key), cache).encrypt_block(bytes(input)) == encrypted
+    assert cache.get(bytes(key)) == expand_key(bytes(key))
+    assert cache.cache_info() == CacheInfo(0, 2, 0, 0, 0)
+
+
+if __name__ == "__main__":
+    selftest()
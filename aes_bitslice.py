@@ -0,0 +1,301 @@
+# Bitsliced AES using NumPy
+#
+# A batch of blocks is transposed into 128 bit-planes, plane (i, j) holds
+# bit j (j = 0 being the most significant bit) of byte i of every block, with
+# 64 blocks packed into each uint64 word. Every bitwise operation on a plane
+# then computes the same step of the cipher for 64 blocks at once.
+#
+# In this representation
+# 1) SubBytes() is evaluated as a boolean circuit over the 8 planes of a byte
+#    instead of table lookups
+# 2) ShiftRows() is a reordering of the byte planes
+# 3) MixColumns() is XORs of byte planes, where multiplication by {02}
+#    (x_times) is a reordering of bit planes with 3 XORs
+# 4) AddRoundKey() XORs each plane with all zeros or all ones, depending on
+#    the corresponding bit of the round key
+#
+# Reference:
+# J. Boyar, R. Peralta, "A depth-16 circuit for the AES S-box", 2011
+# https://eprint.iacr.org/2011/332.pdf
+import time
+
+import numpy as np
+
+import aes
+
+BLOCK_SIZE = 16
+ALL_ONES = np.uint64(0xFFFFFFFFFFFFFFFF)
+# Blocks per batch, large batches are split so that the planes and the
+# temporaries of the S-box circuit stay in cache
+BATCH_BLOCKS = 1 << 14
+
+# s'[r, c] = s[r, (c + r) mod 4], with byte index r + 4c
+shift_rows_order = tuple((i + 4 * (i % 4)) % 16 for i in range(16))
+
+
+# Boyar-Peralta circuit for SBox() with 32 AND and 83 XOR/XNOR gates, U0 and
+# S0 are the most significant bits of the input and output bytes. The same
+# code works on Python ints and NumPy arrays
+def sbox_circuit(U0, U1, U2, U3, U4, U5, U6, U7):
+    T1 = U0 ^ U3
+    T2 = U0 ^ U5
+    T3 = U0 ^ U6
+    T4 = U3 ^ U5
+    T5 = U4 ^ U6
+    T6 = T1 ^ T5
+    T7 = U1 ^ U2
+    T8 = U7 ^ T6
+    T9 = U7 ^ T7
+    T10 = T6 ^ T7
+    T11 = U1 ^ U5
+    T12 = U2 ^ U5
+    T13 = T3 ^ T4
+    T14 = T6 ^ T11
+    T15 = T5 ^ T11
+    T16 = T5 ^ T12
+    T17 = T9 ^ T16
+    T18 = U3 ^ U7
+    T19 = T7 ^ T18
+    T20 = T1 ^ T19
+    T21 = U6 ^ U7
+    T22 = T7 ^ T21
+    T23 = T2 ^ T22
+    T24 = T2 ^ T10
+    T25 = T20 ^ T17
+    T26 = T3 ^ T16
+    T27 = T1 ^ T12
+    D = U7
+    M1 = T13 & T6
+    M2 = T23 & T8
+    M3 = T14 ^ M1
+    M4 = T19 & D
+    M5 = M4 ^ M1
+    M6 = T3 & T16
+    M7 = T22 & T9
+    M8 = T26 ^ M6
+    M9 = T20 & T17
+    M10 = M9 ^ M6
+    M11 = T1 & T15
+    M12 = T4 & T27
+    M13 = M12 ^ M11
+    M14 = T2 & T10
+    M15 = M14 ^ M11
+    M16 = M3 ^ M2
+    M17 = M5 ^ T24
+    M18 = M8 ^ M7
+    M19 = M10 ^ M15
+    M20 = M16 ^ M13
+    M21 = M17 ^ M15
+    M22 = M18 ^ M13
+    M23 = M19 ^ T25
+    M24 = M22 ^ M23
+    M25 = M22 & M20
+    M26 = M21 ^ M25
+    M27 = M20 ^ M21
+    M28 = M23 ^ M25
+    M29 = M28 & M27
+    M30 = M26 & M24
+    M31 = M20 & M23
+    M32 = M27 & M31
+    M33 = M27 ^ M25
+    M34 = M21 & M22
+    M35 = M24 & M34
+    M36 = M24 ^ M25
+    M37 = M21 ^ M29
+    M38 = M32 ^ M33
+    M39 = M23 ^ M30
+    M40 = M35 ^ M36
+    M41 = M38 ^ M40
+    M42 = M37 ^ M39
+    M43 = M37 ^ M38
+    M44 = M39 ^ M40
+    M45 = M42 ^ M41
+    M46 = M44 & T6
+    M47 = M40 & T8
+    M48 = M39 & D
+    M49 = M43 & T16
+    M50 = M38 & T9
+    M51 = M37 & T17
+    M52 = M42 & T15
+    M53 = M45 & T27
+    M54 = M41 & T10
+    M55 = M44 & T13
+    M56 = M40 & T23
+    M57 = M39 & T19
+    M58 = M43 & T3
+    M59 = M38 & T22
+    M60 = M37 & T20
+    M61 = M42 & T1
+    M62 = M45 & T4
+    M63 = M41 & T2
+    L0 = M61 ^ M62
+    L1 = M50 ^ M56
+    L2 = M46 ^ M48
+    L3 = M47 ^ M55
+    L4 = M54 ^ M58
+    L5 = M49 ^ M61
+    L6 = M62 ^ L5
+    L7 = M46 ^ L3
+    L8 = M51 ^ M59
+    L9 = M52 ^ M53
+    L10 = M53 ^ L4
+    L11 = M60 ^ L2
+    L12 = M48 ^ M51
+    L13 = M50 ^ L0
+    L14 = M52 ^ M61
+    L15 = M55 ^ L1
+    L16 = M56 ^ L0
+    L17 = M57 ^ L1
+    L18 = M58 ^ L8
+    L19 = M63 ^ L4
+    L20 = L0 ^ L1
+    L21 = L1 ^ L7
+    L22 = L3 ^ L12
+    L23 = L18 ^ L2
+    L24 = L15 ^ L9
+    L25 = L6 ^ L10
+    L26 = L7 ^ L9
+    L27 = L8 ^ L10
+    L28 = L11 ^ L14
+    L29 = L11 ^ L17
+    S0 = L6 ^ L24
+    S1 = ~(L16 ^ L26)
+    S2 = ~(L19 ^ L28)
+    S3 = L6 ^ L21
+    S4 = L20 ^ L22
+    S5 = L25 ^ L29
+    S6 = ~(L13 ^ L27)
+    S7 = ~(L6 ^ L23)
+    return S0, S1, S2, S3, S4, S5, S6, S7
+
+
+def sub_bytes(planes: np.ndarray) -> np.ndarray:
+    return np.stack(sbox_circuit(*planes.swapaxes(0, 1)), axis=1)
+
+
+def shift_rows(planes: np.ndarray) -> np.ndarray:
+    return planes[list(shift_rows_order)]
+
+
+# Multiplication by {02} moves every bit one place to the left, and the
+# carried out bit b7 is reduced by XORing it into bits 4, 3 and 1 (and 0)
+def x_times(b: np.ndarray) -> np.ndarray:
+    b7 = b[:, 0]
+    return np.stack(
+        (
+            b[:, 1],
+            b[:, 2],
+            b[:, 3],
+            b[:, 4] ^ b7,
+            b[:, 5] ^ b7,
+            b[:, 6],
+            b[:, 7] ^ b7,
+            b7,
+        ),
+        axis=1,
+    )
+
+
+# For a column [a0, a1, a2, a3]
+# a0' = {02}•(a0 ⊕ a1) ⊕ a1 ⊕ a2 ⊕ a3 and likewise for a1', a2', a3'
+def mix_columns(planes: np.ndarray) -> np.ndarray:
+    # Bytes of row r of every column are planes[r::4]
+    a0, a1, a2, a3 = planes[0::4], planes[1::4], planes[2::4], planes[3::4]
+    out = np.empty_like(planes)
+    total = a0 ^ a1 ^ a2 ^ a3
+    out[0::4] = a0 ^ total ^ x_times(a0 ^ a1)
+    out[1::4] = a1 ^ total ^ x_times(a1 ^ a2)
+    out[2::4] = a2 ^ total ^ x_times(a2 ^ a3)
+    out[3::4] = a3 ^ total ^ x_times(a3 ^ a0)
+    return out
+
+
+# Expands the packed round keys of aes.round_key_words() into one mask per
+# bit-plane and round, shape (nr + 1, 16, 8, 1)
+def round_key_masks(nr: int, rk) -> np.ndarray:
+    key_bytes = np.array(rk[: 4 * (nr + 1)], dtype=">u4").view(np.uint8)
+    bits = np.unpackbits(key_bytes).reshape(nr + 1, BLOCK_SIZE, 8, 1)
+    return bits.astype(np.uint64) * ALL_ONES
+
+
+# Transposes an (N, 16) uint8 array into (16, 8, ceil(N / 64)) uint64
+# bit-planes, the batch is padded with zero blocks to a multiple of 64
+def to_planes(blocks: np.ndarray) -> np.ndarray:
+    n = len(blocks)
+    padded = np.zeros((-(-n // 64) * 64, BLOCK_SIZE), dtype=np.uint8)
+    padded[:n] = blocks
+    bits = np.ascontiguousarray(np.unpackbits(padded, axis=1).T)
+    return np.packbits(bits, axis=1).view(np.uint64).reshape(BLOCK_SIZE, 8, -1)
+
+
+def from_planes(planes: np.ndarray, n: int) -> np.ndarray:
+    bits = np.unpackbits(planes.reshape(128, -1).view(np.uint8), axis=1)
+    return np.packbits(np.ascontiguousarray(bits.T[:n]), axis=1)
+
+
+# Encrypts a batch of blocks given as an (N, 16) uint8 array with the round
+# keys packed by aes.round_key_words(), returns an (N, 16) uint8 array
+def encrypt_blocks(blocks: np.ndarray, nr: int, rk) -> np.ndarray:
+    blocks = blocks.reshape(-1, BLOCK_SIZE)
+    masks = round_key_masks(nr, rk)
+    out = np.empty_like(blocks)
+    for start in range(0, len(blocks), BATCH_BLOCKS):
+        batch = blocks[start : start + BATCH_BLOCKS]
+        planes = to_planes(batch) ^ masks[0]
+        for round in range(1, nr):
+            planes = mix_columns(shift_rows(sub_bytes(planes))) ^ masks[round]
+        planes = shift_rows(sub_bytes(planes)) ^ masks[nr]
+        out[start : start + len(batch)] = from_planes(planes, len(batch))
+    return out
+
+
+# Blocks per second of the table-based and the bitsliced engines for batch
+# sizes from 64 to 1M blocks. The pure Python engine is only timed for small
+# batches
+def benchmark(sizes=tuple(64 << (2 * i) for i in range(8))) -> None:
+    import aes_numpy
+
+    nr, rk, _ = aes.expand_key(bytes(range(16)))
+    print(f"{'blocks':>8} {'t-table':>12} {'numpy':>12} {'bitslice':>12}")
+    for n in sizes:
+        blocks = np.random.randint(0, 256, (n, BLOCK_SIZE), dtype=np.uint8)
+        rates = []
+        engines = (
+            lambda: [aes.encrypt_block(b, nr, rk) for b in map(bytes, blocks)],
+            lambda: aes_numpy.encrypt_blocks(blocks, nr, rk),
+            lambda: encrypt_blocks(blocks, nr, rk),
+        )
+        for i, engine in enumerate(engines):
+            if i == 0 and n > 4096:
+                rates.append("-")
+                continue
+            start = time.perf_counter()
+            engine()
+            rates.append(f"{n / (time.perf_counter() - start):.0f}")
+        print(f"{n:>8} {rates[0]:>12} {rates[1]:>12} {rates[2]:>12}")
+
+
+# Checks the FIPS-197 vectors against the reference cipher, run with
+# python -m aes_bitslice
+def selftest() -> None:
+    # FIPS-197 Appendix C example vectors for AES-128, AES-192 and AES-256
+    plaintext = list(range(0x00, 0x100, 0x11))
+    for nk, want in (
+        (4, "69c4e0d86a7b0430d8cdb78070b4c55a"),
+        (6, "dda97ca4864cdfe06eaf70a0ec0d7191"),
+        (8, "8ea2b7ca516745bfeafc49904b496089"),
+    ):
+        nr = nk + 6
+        w = aes.key_expansion(list(range(4 * nk)), nk, nr)
+        state = aes.cipher(plaintext, nr, w)
+        expected = bytes(state[r][c] for c in range(4) for r in range(4))
+        assert expected.hex() == want
+        got = encrypt_blocks(
+            np.array([plaintext], dtype=np.uint8), nr, aes.round_key_words(w)
+        )
+        assert got.tobytes() == expected
+
+
+if __name__ == "__main__":
+    selftest()
+    benchmark()
@@ -0,0 +1,256 @@
+# AES on batches of blocks using NumPy
+#
+# Every round of the T-table cipher in aes.py is applied to all the blocks of
+# a batch at once. The state of a batch of N blocks is kept as 4 arrays of
+# N column words, so a round becomes 16 table gathers and XORs over arrays
+# instead of 16 lookups per block in Python.
+import numpy as np
+
+import aes
+
+BLOCK_SIZE = 16
+# Number of blocks processed per batch, bounds the temporary arrays to a few
+# MB while keeping the per-call overhead of NumPy negligible
+BATCH_BLOCKS = 1 << 16
+
+s_box = np.array(aes.s_box_flat, dtype=np.uint32)
+inv_s_box = np.array(aes.inv_s_box_flat, dtype=np.uint32)
+s_box_bytes = np.array(aes.s_box_flat, dtype=np.uint8)
+r_con = np.array(aes.r_con, dtype=np.uint8)
+
+
+# The T-tables are copied from aes.py on first use, like the tables of aes.py
+# itself
+def build_t_tables() -> None:
+    global t_0, t_1, t_2, t_3, inv_t_0, inv_t_1, inv_t_2, inv_t_3
+    if "inv_t_3" in globals():
+        return
+    t_0, t_1, t_2, t_3 = (
+        np.array(t, dtype=np.uint32) for t in (aes.t_0, aes.t_1, aes.t_2, aes.t_3)
+    )
+    inv_t_0, inv_t_1, inv_t_2, inv_t_3 = (
+        np.array(t, dtype=np.uint32)
+        for t in (aes.inv_t_0, aes.inv_t_1, aes.inv_t_2, aes.inv_t_3)
+    )
+
+
+def __getattr__(name: str):
+    if name in aes.T_TABLES:
+        build_t_tables()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# KeyExpansion() for K keys of the same length at once, given as a (K, 4 * nk)
+# uint8 array. Returns the schedules as a (K, 4 * (nr + 1), 4) uint8 array,
+# where schedules[j] is aes.key_expansion() of the j-th key. Every step of
+# the expansion, including RotWord(), SubWord() and the Rcon XOR, is done for
+# all the keys with one array operation
+def key_expansion_batch(keys: np.ndarray) -> np.ndarray:
+    keys = np.asarray(keys, dtype=np.uint8)
+    if keys.ndim != 2 or keys.shape[1] not in (16, 24, 32):
+        raise ValueError(f"keys must have shape (K, 16/24/32), got {keys.shape}")
+    nk = keys.shape[1] // 4
+    nr = nk + 6
+    w = np.empty((len(keys), 4 * (nr + 1), 4), dtype=np.uint8)
+    w[:, :nk] = keys.reshape(len(keys), nk, 4)
+    for i in range(nk, 4 * (nr + 1)):
+        temp = w[:, i - 1]
+        if i % nk == 0:
+            temp = s_box_bytes[np.roll(temp, -1, axis=1)]
+            temp[:, 0] ^= r_con[i // nk - 1]
+        elif nk > 6 and i % nk == 4:
+            temp = s_box_bytes[temp]
+        w[:, i] = w[:, i - nk] ^ temp
+    return w
+
+
+# Packs schedules of key_expansion_batch() into 32-bit words, shape
+# (K, 4 * (nr + 1)), in the layout of aes.round_key_words()
+def schedule_words(schedules: np.ndarray) -> np.ndarray:
+    words = np.ascontiguousarray(schedules).view(">u4")
+    return words.reshape(len(schedules), -1).astype(np.uint32)
+
+
+# Encrypts a batch of blocks given as an (N, 16) uint8 array with the round
+# keys packed by aes.round_key_words(), returns an (N, 16) uint8 array.
+#
+# The round keys may also have shape (4 * (nr + 1), N), in which case block
+# i is encrypted with the round keys rk[:, i]
+def encrypt_blocks(blocks: np.ndarray, nr: int, rk) -> np.ndarray:
+    build_t_tables()
+    words = blocks.reshape(-1, BLOCK_SIZE).view(">u4").astype(np.uint32)
+    rk = np.asarray(rk, dtype=np.uint32)
+    s0 = words[:, 0] ^ rk[0]
+    s1 = words[:, 1] ^ rk[1]
+    s2 = words[:, 2] ^ rk[2]
+    s3 = words[:, 3] ^ rk[3]
+    for k in range(4, 4 * nr, 4):
+        b0 = (s0 >> 24, s0 >> 16 & 0xFF, s0 >> 8 & 0xFF, s0 & 0xFF)
+        b1 = (s1 >> 24, s1 >> 16 & 0xFF, s1 >> 8 & 0xFF, s1 & 0xFF)
+        b2 = (s2 >> 24, s2 >> 16 & 0xFF, s2 >> 8 & 0xFF, s2 & 0xFF)
+        b3 = (s3 >> 24, s3 >> 16 & 0xFF, s3 >> 8 & 0xFF, s3 & 0xFF)
+        # fmt: off
+        s0 = t_0[b0[0]] ^ t_1[b1[1]] ^ t_2[b2[2]] ^ t_3[b3[3]] ^ rk[k]
+        s1 = t_0[b1[0]] ^ t_1[b2[1]] ^ t_2[b3[2]] ^ t_3[b0[3]] ^ rk[k + 1]
+        s2 = t_0[b2[0]] ^ t_1[b3[1]] ^ t_2[b0[2]] ^ t_3[b1[3]] ^ rk[k + 2]
+        s3 = t_0[b3[0]] ^ t_1[b0[1]] ^ t_2[b1[2]] ^ t_3[b2[3]] ^ rk[k + 3]
+        # fmt: on
+    k = 4 * nr
+    out = np.empty((len(words), 4), dtype=">u4")
+    s = s_box
+    # fmt: off
+    out[:, 0] = (s[s0 >> 24] << 24 | s[s1 >> 16 & 0xFF] << 16 | s[s2 >> 8 & 0xFF] << 8 | s[s3 & 0xFF]) ^ rk[k]
+    out[:, 1] = (s[s1 >> 24] << 24 | s[s2 >> 16 & 0xFF] << 16 | s[s3 >> 8 & 0xFF] << 8 | s[s0 & 0xFF]) ^ rk[k + 1]
+    out[:, 2] = (s[s2 >> 24] << 24 | s[s3 >> 16 & 0xFF] << 16 | s[s0 >> 8 & 0xFF] << 8 | s[s1 & 0xFF]) ^ rk[k + 2]
+    out[:, 3] = (s[s3 >> 24] << 24 | s[s0 >> 16 & 0xFF] << 16 | s[s1 >> 8 & 0xFF] << 8 | s[s2 & 0xFF]) ^ rk[k + 3]
+    # fmt: on
+    return out.view(np.uint8).reshape(-1, BLOCK_SIZE)
+
+
+# Decrypts a batch of blocks given as an (N, 16) uint8 array with the round
+# keys packed by aes.inv_round_key_words(), using the equivalent inverse
+# cipher like aes.decrypt_words()
+def decrypt_blocks(blocks: np.ndarray, nr: int, dk) -> np.ndarray:
+    build_t_tables()
+    words = blocks.reshape(-1, BLOCK_SIZE).view(">u4").astype(np.uint32)
+    dk = np.asarray(dk, dtype=np.uint32)
+    s0 = words[:, 0] ^ dk[0]
+    s1 = words[:, 1] ^ dk[1]
+    s2 = words[:, 2] ^ dk[2]
+    s3 = words[:, 3] ^ dk[3]
+    for k in range(4, 4 * nr, 4):
+        b0 = (s0 >> 24, s0 >> 16 & 0xFF, s0 >> 8 & 0xFF, s0 & 0xFF)
+        b1 = (s1 >> 24, s1 >> 16 & 0xFF, s1 >> 8 & 0xFF, s1 & 0xFF)
+        b2 = (s2 >> 24, s2 >> 16 & 0xFF, s2 >> 8 & 0xFF, s2 & 0xFF)
+        b3 = (s3 >> 24, s3 >> 16 & 0xFF, s3 >> 8 & 0xFF, s3 & 0xFF)
+        # fmt: off
+        s0 = inv_t_0[b0[0]] ^ inv_t_1[b3[1]] ^ inv_t_2[b2[2]] ^ inv_t_3[b1[3]] ^ dk[k]
+        s1 = inv_t_0[b1[0]] ^ inv_t_1[b0[1]] ^ inv_t_2[b3[2]] ^ inv_t_3[b2[3]] ^ dk[k + 1]
+        s2 = inv_t_0[b2[0]] ^ inv_t_1[b1[1]] ^ inv_t_2[b0[2]] ^ inv_t_3[b3[3]] ^ dk[k + 2]
+        s3 = inv_t_0[b3[0]] ^ inv_t_1[b2[1]] ^ inv_t_2[b1[2]] ^ inv_t_3[b0[3]] ^ dk[k + 3]
+        # fmt: on
+    k = 4 * nr
+    out = np.empty((len(words), 4), dtype=">u4")
+    s = inv_s_box
+    # fmt: off
+    out[:, 0] = (s[s0 >> 24] << 24 | s[s3 >> 16 & 0xFF] << 16 | s[s2 >> 8 & 0xFF] << 8 | s[s1 & 0xFF]) ^ dk[k]
+    out[:, 1] = (s[s1 >> 24] << 24 | s[s0 >> 16 & 0xFF] << 16 | s[s3 >> 8 & 0xFF] << 8 | s[s2 & 0xFF]) ^ dk[k + 1]
+    out[:, 2] = (s[s2 >> 24] << 24 | s[s1 >> 16 & 0xFF] << 16 | s[s0 >> 8 & 0xFF] << 8 | s[s3 & 0xFF]) ^ dk[k + 2]
+    out[:, 3] = (s[s3 >> 24] << 24 | s[s2 >> 16 & 0xFF] << 16 | s[s1 >> 8 & 0xFF] << 8 | s[s0 & 0xFF]) ^ dk[k + 3]
+    # fmt: on
+    return out.view(np.uint8).reshape(-1, BLOCK_SIZE)
+
+
+# Encrypts block i of an (N, 16) uint8 array under the key schedule
+# schedules[key_ids[i]], with schedules from key_expansion_batch()
+def encrypt_blocks_multikey(
+    blocks: np.ndarray, schedules: np.ndarray, key_ids: np.ndarray
+) -> np.ndarray:
+    nr = schedules.shape[1] // 4 - 1
+    rk = schedule_words(schedules).T[:, np.asarray(key_ids)]
+    return encrypt_blocks(blocks, nr, rk)
+
+
+# Counter blocks are 128-bit big-endian integers, the i-th block of the
+# keystream is encrypted from (counter + i) mod 2^128. Returns the counter
+# blocks start to start + n as an (n, 16) uint8 array
+def counter_blocks(counter: bytes, start: int, n: int) -> np.ndarray:
+    value = (int.from_bytes(counter, "big") + start) % (1 << 128)
+    hi, lo = value >> 64, value & 0xFFFFFFFFFFFFFFFF
+    blocks = np.empty((n, 2), dtype=">u8")
+    low = np.arange(n, dtype=np.uint64) + np.uint64(lo)
+    blocks[:, 1] = low
+    # The low half wraps around at most once within a batch, every block
+    # after that carries 1 into the high half
+    blocks[:, 0] = np.uint64(hi) + (low < np.uint64(lo)).astype(np.uint64)
+    return blocks.view(np.uint8)
+
+
+def ctr_keystream(nr: int, rk, counter: bytes, start: int, n: int) -> np.ndarray:
+    return encrypt_blocks(counter_blocks(counter, start, n), nr, rk)
+
+
+# CTR mode encryption, decryption is the same operation. The data is
+# processed in batches of batch_blocks blocks, a trailing partial block uses
+# the first bytes of its keystream block
+def ctr_crypt(
+    key: bytes, counter: bytes, data: bytes, batch_blocks: int = BATCH_BLOCKS
+) -> bytes:
+    if len(counter) != BLOCK_SIZE:
+        raise ValueError(f"invalid counter block length: {len(counter)} bytes")
+    nr, rk, _ = aes.key_schedule_cache.get(key)
+    rk = np.asarray(rk, dtype=np.uint32)
+    src = np.frombuffer(data, dtype=np.uint8)
+    out = np.empty_like(src)
+    step = batch_blocks * BLOCK_SIZE
+    for offset in range(0, len(src), step):
+        chunk = src[offset : offset + step]
+        n = -(-len(chunk) // BLOCK_SIZE)
+        keystream = ctr_keystream(nr, rk, counter, offset // BLOCK_SIZE, n)
+        np.bitwise_xor(
+            chunk, keystream.reshape(-1)[: len(chunk)], out=out[offset : offset + step]
+        )
+    return out.tobytes()
+
+
+def selftest() -> None:
+    # FIPS-197 Appendix C example vectors for AES-128, AES-192 and AES-256
+    plaintext = bytes(range(0x00, 0x100, 0x11))
+    for key, want in (
+        (bytes(range(16)), "69c4e0d86a7b0430d8cdb78070b4c55a"),
+        (bytes(range(24)), "dda97ca4864cdfe06eaf70a0ec0d7191"),
+        (bytes(range(32)), "8ea2b7ca516745bfeafc49904b496089"),
+    ):
+        nr, rk, dk = aes.expand_key(key)
+        blocks = np.frombuffer(plaintext * 3, dtype=np.uint8).reshape(-1, 16)
+        encrypted = encrypt_blocks(blocks, nr, rk)
+        assert encrypted.tobytes() == bytes.fromhex(want) * 3
+        assert decrypt_blocks(encrypted, nr, dk).tobytes() == plaintext * 3
+
+    # Batch key schedules against aes.key_expansion(), and every block
+    # encrypted under its own key against aes.AES
+    keys = np.frombuffer(bytes(range(7, 256)), dtype=np.uint8)
+    blocks = np.frombuffer(bytes(range(5 * 16)), dtype=np.uint8).reshape(-1, 16)
+    key_ids = np.array([2, 0, 1, 2, 1])
+    for nk in (4, 6, 8):
+        batch = keys[: 3 * 4 * nk].reshape(3, 4 * nk)
+        schedules = key_expansion_batch(batch)
+        for key, schedule in zip(batch, schedules):
+            assert schedule.tolist() == aes.key_expansion(key.tolist(), nk, nk + 6)
+        got = encrypt_blocks_multikey(blocks, schedules, key_ids)
+        for block, i, out in zip(blocks, key_ids, got):
+            want = aes.AES(batch[i].tobytes()).encrypt_block(block.tobytes())
+            assert out.tobytes() == want
+
+    # SP 800-38A F.5.1 and F.5.2, CTR-AES128 encryption and decryption
+    key = bytes.fromhex("2b7e151628aed2a6abf7158809cf4f3c")
+    counter = bytes.fromhex("f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff")
+    plaintext = bytes.fromhex(
+        "6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51"
+        "30c81c46a35ce411e5fbc1191a0a52eff69f2445df4f9b17ad2b417be66c3710"
+    )
+    ciphertext = bytes.fromhex(
+        "874d6191b620e3261bef6864990db6ce9806f66b7970fdff8617187bb9fffdff"
+        "5ae4df3edbd5d35e5b4f09020db03eab1e031dda2fbe03d1792170a0f3009cee"
+    )
+    assert ctr_crypt(key, counter, plaintext) == ciphertext
+    assert ctr_crypt(key, counter, ciphertext) == plaintext
+    # A partial last block, and batches smaller than the data
+    assert ctr_crypt(key, counter, plaintext[:37], batch_blocks=1) == ciphertext[:37]
+
+    # Counters wrapping in the low 64 bits and at 2^128, against single blocks
+    cipher = aes.AES(key)
+    for value in ((1 << 64) - 2, (1 << 128) - 2):
+        keystream = b"".join(
+            cipher.encrypt_block(((value + i) % (1 << 128)).to_bytes(16, "big"))
+            for i in range(4)
+        )
+        want = bytes(a ^ b for a, b in zip(plaintext, keystream))
+        counter = value.to_bytes(16, "big")
+        assert ctr_crypt(key, counter, plaintext) == want
+        assert ctr_crypt(key, counter, plaintext, batch_blocks=3) == want
+
+
+if __name__ == "__main__":
+    selftest()
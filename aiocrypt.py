@@ -0,0 +1,307 @@
+# asyncio front end for the streaming modes of filecrypt
+#
+# The block work of every chunk runs in an executor, so the event loop only
+# does the bookkeeping (alignment, IVs and ordering) and other coroutines keep
+# running while large payloads are encrypted. With the default thread
+# executor the work still shares the GIL with the loop, which only bounds
+# the latency of other tasks. A ProcessPoolExecutor also spreads chunks of
+# the parallel modes over several cores.
+#
+# Chunks are submitted in order and their results are returned in the same
+# order. CTR chunks and CBC decryption chunks are independent of each other
+# (their counter or IV is known from the input), so up to window of them are
+# in flight at once. CBC encryption is chained: a chunk is started once the
+# last ciphertext block of the previous one is known. submit() waits while
+# window chunks are in flight, which applies backpressure to the producer.
+#
+# The stream format is the one of filecrypt: the IV or initial counter block
+# comes first, CBC uses PKCS#7 padding.
+import asyncio
+import io
+import os
+from concurrent.futures import Executor
+from functools import lru_cache
+from typing import Optional
+
+import filecrypt
+from filecrypt import xor_bytes
+
+CHUNK_SIZE = 1 << 16
+# Chunks submitted to the executor and not finished yet
+WINDOW = 4
+
+
+# Each worker process builds its cipher once per key
+@lru_cache(maxsize=64)
+def make_cipher(cipher_name: str, key: bytes):
+    return filecrypt.CIPHERS[cipher_name](key)
+
+
+# Processes a block-aligned chunk in the executor, without padding. For CTR
+# the iv is the counter block of the first block of the chunk, for CBC it is
+# the ciphertext block preceding the chunk. The CTR chunk may end with a
+# partial block
+def crypt_chunk(
+    cipher_name: str, key: bytes, mode: str, decrypt: bool, iv: bytes, data: bytes
+) -> bytes:
+    cipher = make_cipher(cipher_name, key)
+    if mode == "ctr":
+        return b"".join(filecrypt.ctr_crypt(cipher, iv, [data]))
+    size = cipher.block_size
+    out = []
+    prev = iv
+    for i in range(0, len(data), size):
+        block = data[i : i + size]
+        if decrypt:
+            out.append(xor_bytes(cipher.decrypt_block(block), prev))
+            prev = block
+        else:
+            prev = cipher.encrypt_block(xor_bytes(block, prev))
+            out.append(prev)
+    return b"".join(out)
+
+
+class AsyncEncryptor:
+    def __init__(
+        self,
+        key: bytes,
+        cipher_name: str = "aes",
+        mode: str = "ctr",
+        iv: Optional[bytes] = None,
+        decrypt: bool = False,
+        executor: Optional[Executor] = None,
+        window: int = WINDOW,
+    ):
+        if cipher_name not in filecrypt.CIPHERS:
+            raise ValueError(f"unknown cipher: {cipher_name}")
+        if mode not in filecrypt.MODES:
+            raise ValueError(f"unknown mode: {mode}")
+        if window < 1:
+            raise ValueError("window must be at least 1")
+        self.key = bytes(key)
+        # Validates the key before anything is sent to the executor
+        self.block_size = make_cipher(cipher_name, self.key).block_size
+        if iv is None:
+            if decrypt:
+                raise ValueError("decryption needs the IV")
+            iv = os.urandom(self.block_size)
+        if len(iv) != self.block_size:
+            raise ValueError(f"IV must be {self.block_size} bytes")
+        self.iv = bytes(iv)
+        self.cipher_name = cipher_name
+        self.mode = mode
+        self.decrypt = decrypt
+        self.executor = executor
+        self.window = asyncio.Semaphore(window)
+        # Input not submitted yet, less than a block or the block held back
+        # for the padding
+        self.pending = b""
+        # Counter block or IV of the next chunk
+        self.next_iv = self.iv
+        self.last: Optional[asyncio.Future] = None
+        self.finalized = False
+
+    async def run(self, iv, data: bytes) -> bytes:
+        if isinstance(iv, asyncio.Future):
+            iv = (await iv)[-self.block_size :]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            crypt_chunk,
+            self.cipher_name,
+            self.key,
+            self.mode,
+            self.decrypt,
+            iv,
+            data,
+        )
+
+    # Starts the processing of data, the part that can be processed so far,
+    # and returns the task that produces its output
+    def start(self, data: bytes) -> asyncio.Future:
+        size = self.block_size
+        if not data:
+            self.window.release()
+            done = asyncio.get_running_loop().create_future()
+            done.set_result(b"")
+            return done
+        if self.mode == "ctr":
+            iv = self.next_iv
+            counter = int.from_bytes(iv, "big") + len(data) // size
+            self.next_iv = (counter % (1 << (8 * size))).to_bytes(size, "big")
+        elif self.decrypt:
+            iv = self.next_iv
+            self.next_iv = data[-size:]
+        else:
+            # The IV is the last ciphertext block of the previous chunk
+            iv = self.last if self.last is not None else self.iv
+        task = asyncio.ensure_future(self.run(iv, data))
+        # The slot is released when the task is done, including a task
+        # cancelled before its coroutine started
+        task.add_done_callback(lambda _: self.window.release())
+        if self.mode == "cbc" and not self.decrypt:
+            self.last = task
+        return task
+
+    # Waits for room in the window and submits chunk, returns a future for
+    # its output, which may be shorter or longer than chunk because partial
+    # blocks are carried over to the next chunk
+    async def submit(self, chunk: bytes) -> asyncio.Future:
+        if self.finalized:
+            raise ValueError("the encryptor has been finalized")
+        await self.window.acquire()
+        data = self.pending + bytes(chunk)
+        size = self.block_size
+        n = len(data) - len(data) % size
+        if self.mode == "cbc" and self.decrypt and n == len(data):
+            n -= size
+        n = max(n, 0)
+        self.pending = data[n:]
+        return self.start(data[:n])
+
+    # Also decrypts when the encryptor was created with decrypt=True
+    async def encrypt(self, chunk: bytes) -> bytes:
+        return await (await self.submit(chunk))
+
+    # Processes the remaining input, returns the last output
+    async def finalize(self) -> bytes:
+        if self.finalized:
+            raise ValueError("the encryptor has been finalized")
+        self.finalized = True
+        size = self.block_size
+        data = self.pending
+        self.pending = b""
+        if self.mode == "cbc":
+            if self.decrypt:
+                if len(data) != size:
+                    raise ValueError("ciphertext is not a multiple of the block size")
+            else:
+                data = filecrypt.pad(data, size)
+        await self.window.acquire()
+        out = await self.start(data)
+        if self.mode == "cbc" and self.decrypt:
+            out = filecrypt.unpad(out, size)
+        return out
+
+
+async def crypt_stream(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    key: bytes,
+    cipher_name: str = "aes",
+    mode: str = "ctr",
+    decrypt: bool = False,
+    iv: Optional[bytes] = None,
+    executor: Optional[Executor] = None,
+    window: int = WINDOW,
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    if cipher_name not in filecrypt.CIPHERS:
+        raise ValueError(f"unknown cipher: {cipher_name}")
+    size = make_cipher(cipher_name, bytes(key)).block_size
+    if decrypt:
+        try:
+            iv = await reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise ValueError("input is too short to contain an IV") from None
+    encryptor = AsyncEncryptor(
+        key, cipher_name, mode, iv, decrypt, executor=executor, window=window
+    )
+    # Bytes read from reader, the IV only counts when it is read
+    total = size if decrypt else 0
+    if not decrypt:
+        writer.write(encryptor.iv)
+    # Outputs are written in submission order, the oldest one is waited for
+    # once window chunks are queued
+    queue: list[asyncio.Future] = []
+    try:
+        while True:
+            chunk = await reader.read(chunk_size)
+            if not chunk:
+                break
+            total += len(chunk)
+            queue.append(await encryptor.submit(chunk))
+            while queue and (queue[0].done() or len(queue) >= window):
+                writer.write(await queue.pop(0))
+                await writer.drain()
+        for task in queue:
+            writer.write(await task)
+        queue = []
+        writer.write(await encryptor.finalize())
+        await writer.drain()
+    finally:
+        for task in queue:
+            task.cancel()
+    return total
+
+
+async def encrypt_stream(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, key: bytes, **kwargs
+) -> int:
+    return await crypt_stream(reader, writer, key, **kwargs)
+
+
+async def decrypt_stream(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, key: bytes, **kwargs
+) -> int:
+    return await crypt_stream(reader, writer, key, decrypt=True, **kwargs)
+
+
+# Collects what crypt_stream writes, in place of an asyncio.StreamWriter
+class BufferWriter:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self.data += data
+
+    async def drain(self) -> None:
+        pass
+
+
+async def stream_output(data: bytes, key: bytes, **kwargs) -> tuple[bytes, int]:
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    writer = BufferWriter()
+    total = await crypt_stream(reader, writer, key, **kwargs)
+    return bytes(writer.data), total
+
+
+# The stream adapter against filecrypt.crypt_stream, with chunks that split
+# blocks and a window small enough for submit() to wait
+async def check_streams() -> None:
+    keys = {"aes": bytes(range(16)), "des": bytes(range(8)), "3des": bytes(range(24))}
+    for cipher_name, key in keys.items():
+        iv = bytes(range(100, 100 + make_cipher(cipher_name, key).block_size))
+        for mode in filecrypt.MODES:
+            for length in (0, 5, 16, 100):
+                data = bytes(range(length))
+                want = io.BytesIO()
+                filecrypt.crypt_stream(
+                    io.BytesIO(data), want, cipher_name, mode, key, iv=iv
+                )
+                options = dict(cipher_name=cipher_name, mode=mode, window=2)
+                encrypted, total = await stream_output(
+                    data, key, iv=iv, chunk_size=7, **options
+                )
+                assert encrypted == want.getvalue()
+                assert total == length
+                decrypted, total = await stream_output(
+                    encrypted, key, decrypt=True, chunk_size=11, **options
+                )
+                assert decrypted == data
+                assert total == len(encrypted)
+
+    # A chunk cancelled before it started gives its slot back
+    encryptor = AsyncEncryptor(bytes(16), window=1)
+    (await encryptor.submit(bytes(32))).cancel()
+    await asyncio.wait_for(encryptor.encrypt(bytes(32)), 5)
+
+
+def selftest() -> None:
+    asyncio.run(check_streams())
+
+
+if __name__ == "__main__":
+    selftest()
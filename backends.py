@@ -0,0 +1,203 @@
+# Registry of the engines that encrypt and decrypt many blocks under one key
+#
+# Each cipher has up to 3 engines:
+# 1) reference: the list-based functions of aes.py and des.py
+# 2) table: the T-table engine of aes.py and the SP-table engine of des.py
+# 3) numpy: aes_numpy and des_bitslice, available when NumPy is installed
+#
+# The engine of a cipher is selected on first use: the fastest available
+# one in the order of ENGINES (measured with python -m bench), unless the
+# environment variable AES_BACKEND or DES_BACKEND names another one.
+# Availability is checked with importlib.util.find_spec(), so nothing is
+# imported before an engine is used.
+#
+# All engines take the key as bytes and data whose length is a multiple of
+# the block size, and process it in ECB mode.
+import importlib
+import importlib.util
+import os
+from typing import Callable, NamedTuple, Optional
+
+# Fastest first
+ENGINES = ("numpy", "table", "reference")
+ENVIRONMENT = {"aes": "AES_BACKEND", "des": "DES_BACKEND"}
+BLOCK_SIZES = {"aes": 16, "des": 8}
+
+
+class Backend(NamedTuple):
+    cipher: str
+    name: str
+    # Modules imported by the engine
+    requires: tuple[str, ...]
+    encrypt: Callable[[bytes, bytes], bytes]
+    decrypt: Callable[[bytes, bytes], bytes]
+
+    def available(self) -> bool:
+        return all(importlib.util.find_spec(module) for module in self.requires)
+
+
+def blocks(data: bytes, size: int) -> list[bytes]:
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def aes_reference(key: bytes, data: bytes, decrypt: bool) -> bytes:
+    aes = importlib.import_module("aes")
+    if len(key) not in (16, 24, 32):
+        raise ValueError(f"invalid AES key length: {len(key)} bytes")
+    nk = len(key) // 4
+    nr = nk + 6
+    w = aes.key_expansion(list(key), nk, nr)
+    crypt = aes.inv_cipher if decrypt else aes.cipher
+    out = []
+    for block in blocks(data, 16):
+        state = crypt(list(block), nr, w)
+        out.append(bytes(state[r][c] for c in range(4) for r in range(4)))
+    return b"".join(out)
+
+
+def aes_table(key: bytes, data: bytes, decrypt: bool) -> bytes:
+    cipher = importlib.import_module("aes").AES(key)
+    out = bytearray(len(data))
+    (cipher.decrypt_into if decrypt else cipher.encrypt_into)(out, data)
+    return bytes(out)
+
+
+def aes_numpy(key: bytes, data: bytes, decrypt: bool) -> bytes:
+    aes = importlib.import_module("aes")
+    engine = importlib.import_module("aes_numpy")
+    nr, rk, dk = aes.key_schedule_cache.get(key)
+    src = engine.np.frombuffer(data, dtype=engine.np.uint8).reshape(-1, 16)
+    if decrypt:
+        return engine.decrypt_blocks(src, nr, dk).tobytes()
+    return engine.encrypt_blocks(src, nr, rk).tobytes()
+
+
+def des_reference(key: bytes, data: bytes, decrypt: bool) -> bytes:
+    des = importlib.import_module("des")
+    if len(key) != 8:
+        raise ValueError(f"invalid DES key length: {len(key)} bytes")
+    crypt = des.des_decrypt if decrypt else des.des_encrypt
+    k = int.from_bytes(key, "big")
+    return b"".join(
+        des.bin_to_dec(crypt(int.from_bytes(block, "big"), k)).to_bytes(8, "big")
+        for block in blocks(data, 8)
+    )
+
+
+def des_table(key: bytes, data: bytes, decrypt: bool) -> bytes:
+    cipher = importlib.import_module("des").DES(key)
+    out = bytearray(len(data))
+    (cipher.decrypt_into if decrypt else cipher.encrypt_into)(out, data)
+    return bytes(out)
+
+
+def des_numpy(key: bytes, data: bytes, decrypt: bool) -> bytes:
+    engine = importlib.import_module("des_bitslice")
+    if len(key) != 8:
+        raise ValueError(f"invalid DES key length: {len(key)} bytes")
+    src = engine.np.frombuffer(data, dtype=engine.np.uint8).reshape(-1, 8)
+    crypt = engine.decrypt_blocks if decrypt else engine.encrypt_blocks
+    return crypt(src, key).tobytes()
+
+
+def make_backend(
+    cipher: str, name: str, requires: tuple[str, ...], crypt: Callable
+) -> Backend:
+    return Backend(
+        cipher,
+        name,
+        requires,
+        lambda key, data: crypt(key, data, False),
+        lambda key, data: crypt(key, data, True),
+    )
+
+
+BACKENDS = {
+    "aes": {
+        "numpy": make_backend("aes", "numpy", ("numpy", "aes_numpy"), aes_numpy),
+        "table": make_backend("aes", "table", ("aes",), aes_table),
+        "reference": make_backend("aes", "reference", ("aes",), aes_reference),
+    },
+    "des": {
+        "numpy": make_backend("des", "numpy", ("numpy", "des_bitslice"), des_numpy),
+        "table": make_backend("des", "table", ("des",), des_table),
+        "reference": make_backend("des", "reference", ("des",), des_reference),
+    },
+}
+# Engine selected for each cipher, filled on first use
+selected: dict[str, Backend] = {}
+
+
+def available(cipher: str) -> list[str]:
+    return [name for name in ENGINES if BACKENDS[cipher][name].available()]
+
+
+def select(cipher: str) -> Backend:
+    if cipher not in BACKENDS:
+        raise ValueError(f"unknown cipher: {cipher}")
+    name = os.environ.get(ENVIRONMENT[cipher])
+    if name:
+        backend = BACKENDS[cipher].get(name)
+        if backend is None:
+            raise ValueError(f"{ENVIRONMENT[cipher]}: unknown backend: {name}")
+        if not backend.available():
+            raise ValueError(f"{ENVIRONMENT[cipher]}: backend {name} is unavailable")
+        return backend
+    for name in ENGINES:
+        if BACKENDS[cipher][name].available():
+            return BACKENDS[cipher][name]
+    raise ValueError(f"no backend available for {cipher}")
+
+
+# Returns the named backend, or the one selected for the cipher
+def get_backend(cipher: str, name: Optional[str] = None) -> Backend:
+    if name is not None:
+        if cipher not in BACKENDS or name not in BACKENDS[cipher]:
+            raise ValueError(f"unknown backend: {cipher}/{name}")
+        return BACKENDS[cipher][name]
+    if cipher not in selected:
+        selected[cipher] = select(cipher)
+    return selected[cipher]
+
+
+def check_length(cipher: str, data: bytes) -> None:
+    if len(data) % BLOCK_SIZES[cipher]:
+        raise ValueError(
+            f"data length must be a multiple of {BLOCK_SIZES[cipher]} bytes"
+        )
+
+
+def encrypt_ecb(cipher: str, key: bytes, data: bytes) -> bytes:
+    backend = get_backend(cipher)
+    check_length(cipher, data)
+    return backend.encrypt(bytes(key), bytes(data))
+
+
+def decrypt_ecb(cipher: str, key: bytes, data: bytes) -> bytes:
+    backend = get_backend(cipher)
+    check_length(cipher, data)
+    return backend.decrypt(bytes(key), bytes(data))
+
+
+# Runs the self-tests of the modules and checks that every available engine
+# agrees with the reference engine
+def selftest() -> None:
+    modules = ["aes", "des", "gcm", "cmac", "ctr", "filecrypt", "aiocrypt", "parallel"]
+    if importlib.util.find_spec("numpy"):
+        modules += ["aes_numpy", "xts", "aes_bitslice", "des_bitslice"]
+    for module in modules:
+        importlib.import_module(module).selftest()
+    for cipher, engines in BACKENDS.items():
+        size = BLOCK_SIZES[cipher]
+        key = bytes(range(2 * size if cipher == "aes" else size))
+        data = bytes(range(256))[: 4 * size]
+        want = engines["reference"].encrypt(key, data)
+        for name in available(cipher):
+            assert engines[name].encrypt(key, data) == want, f"{cipher}/{name}"
+            assert engines[name].decrypt(key, want) == data, f"{cipher}/{name}"
+
+
+if __name__ == "__main__":
+    selftest()
+    for cipher in BACKENDS:
+        print(f"{cipher}: {get_backend(cipher).name} (available: {available(cipher)})")
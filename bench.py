@@ -0,0 +1,391 @@
+# Benchmark suite for the ciphers, modes and engines of the repository
+#
+# Three kinds of benchmarks are run for each cipher:
+# 1) key setup: key expansion and subkey generation
+# 2) latency: one call on a single block
+# 3) throughput: one call on a payload of each of the given sizes, for each
+#    mode and engine, including the engines of the backends registry and the
+#    multi-core ParallelAES
+#
+# Every benchmark is calibrated so that a sample takes at least min_time
+# seconds, and repeat samples are taken. The per-call mean, median and
+# standard deviation are reported with the rate in calls/s and, when the
+# call processes a payload, MB/s. The results can be saved as JSON and
+# compared with a previous run; the runner exits with status 1 when the
+# median time of a benchmark grows by more than the threshold.
+#
+# Usage:
+# python -m bench --output results.json
+# python -m bench --baseline results.json --threshold 0.1 -k aes
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, Iterator, NamedTuple, Optional
+
+import aes
+import backends
+import cmac
+import ctr
+import des
+import filecrypt
+import gcm
+import parallel
+
+# Payload sizes of the throughput benchmarks
+SIZES = (1 << 10, 1 << 14, 1 << 18)
+REPEAT = 5
+MIN_TIME = 0.05
+# Relative growth of the median time reported as a regression
+THRESHOLD = 0.10
+
+
+class Benchmark(NamedTuple):
+    name: str
+    func: Callable[[], object]
+    # Bytes processed per call, 0 when the rate in MB/s is meaningless
+    size: int = 0
+
+
+class Result(NamedTuple):
+    name: str
+    loops: int
+    mean: float
+    median: float
+    stdev: float
+    ops: float
+    mb_s: Optional[float]
+
+
+def aes_benchmarks(sizes: tuple[int, ...]) -> Iterator[Benchmark]:
+    for nk in (4, 6, 8):
+        bits = 32 * nk
+        nr = nk + 6
+        key = bytes(range(4 * nk))
+        w = aes.key_expansion(list(key), nk, nr)
+        yield Benchmark(
+            f"aes-{bits}/key_expansion",
+            lambda key=key, nk=nk, nr=nr: aes.key_expansion(list(key), nk, nr),
+        )
+        yield Benchmark(f"aes-{bits}/expand_key", lambda key=key: aes.expand_key(key))
+        block = list(range(16))
+        yield Benchmark(
+            f"aes-{bits}/cipher", lambda w=w, nr=nr: aes.cipher(block, nr, w), 16
+        )
+        yield Benchmark(
+            f"aes-{bits}/inv_cipher",
+            lambda w=w, nr=nr: aes.inv_cipher(block, nr, w),
+            16,
+        )
+        cipher = aes.AES(key)
+        yield Benchmark(
+            f"aes-{bits}/encrypt_block", lambda c=cipher: c.encrypt_block(bytes(16)), 16
+        )
+        yield Benchmark(
+            f"aes-{bits}/decrypt_block", lambda c=cipher: c.decrypt_block(bytes(16)), 16
+        )
+    key = bytes(range(16))
+    for size in sizes:
+        data = bytes(size)
+        yield Benchmark(
+            f"aes-128/gcm/{size}",
+            lambda data=data: gcm.encrypt(key, bytes(12), data),
+            size,
+        )
+        yield Benchmark(
+            f"aes-128/cmac/{size}",
+            lambda data=data: cmac.CMAC(key, data).digest(),
+            size,
+        )
+
+
+# The filecrypt modes, for every cipher of its registry
+def mode_benchmarks(sizes: tuple[int, ...]) -> Iterator[Benchmark]:
+    keys = {"aes": bytes(range(16)), "des": bytes(range(8)), "3des": bytes(range(24))}
+    for name, key in keys.items():
+        cipher = filecrypt.CIPHERS[name](key)
+        iv = bytes(cipher.block_size)
+        modes = {
+            "cbc-encrypt": lambda data, c=cipher, iv=iv: filecrypt.cbc_encrypt(
+                c, iv, [data]
+            ),
+            "cbc-decrypt": lambda data, c=cipher, iv=iv: filecrypt.cbc_decrypt(
+                c, iv, [data]
+            ),
+            "ctr": lambda data, c=cipher, iv=iv: filecrypt.ctr_crypt(c, iv, [data]),
+        }
+        for mode, run in modes.items():
+            for size in sizes:
+                data = bytes(size)
+                if mode == "cbc-decrypt":
+                    # Decrypting the ciphertext of data gives valid padding
+                    data = b"".join(filecrypt.cbc_encrypt(cipher, iv, [data]))
+                yield Benchmark(
+                    f"{name}/{mode}/{size}",
+                    lambda run=run, data=data: b"".join(run(data)),
+                    size,
+                )
+
+
+def des_benchmarks(sizes: tuple[int, ...]) -> Iterator[Benchmark]:
+    key = 0x133457799BBCDFF1
+    message = 0x74616E7573687269
+    key_bits = des.hex_to_bin(key)
+    subkeys = des.generate_subkeys(key_bits)
+    yield Benchmark("des/generate_subkeys", lambda: des.generate_subkeys(key_bits))
+    yield Benchmark("des/generate_subkeys_int", lambda: des.generate_subkeys_int(key))
+    yield Benchmark("des/TripleDES", lambda: des.TripleDES.from_key(bytes(range(24))))
+    half = des.hex_to_bin(message)[32:]
+    yield Benchmark("des/feistel", lambda: des.feistel(half, subkeys[0]))
+    yield Benchmark("des/des_encrypt", lambda: des.des_encrypt(message, key), 8)
+    yield Benchmark("des/des_decrypt", lambda: des.des_decrypt(message, key), 8)
+    subkeys_int = des.generate_subkeys_int(key)
+    yield Benchmark(
+        "des/des_crypt_int", lambda: des.des_crypt_int(message, subkeys_int), 8
+    )
+    cipher = des.DES(key.to_bytes(8, "big"))
+    yield Benchmark("des/encrypt_block", lambda: cipher.encrypt_block(bytes(8)), 8)
+    triple = des.TripleDES.from_key(bytes(range(24)))
+    yield Benchmark("3des/encrypt_block", lambda: triple.encrypt_block(bytes(8)), 8)
+    for size in sizes:
+        data = bytes(size)
+        yield Benchmark(
+            f"3des/encrypt_cbc/{size}",
+            lambda data=data: triple.encrypt_cbc(bytes(8), data),
+            size,
+        )
+        yield Benchmark(
+            f"3des/decrypt_cbc/{size}",
+            lambda data=data: triple.decrypt_cbc(bytes(8), data),
+            size,
+        )
+
+
+# The engines of the backends registry, called through their Backend entry
+# like backends.encrypt_ecb(). The reference engines only run on the
+# smallest size, a 256 KB payload takes them several seconds per call
+def backends_benchmarks(sizes: tuple[int, ...]) -> Iterator[Benchmark]:
+    keys = {"aes": bytes(range(16)), "des": bytes(range(8))}
+    for cipher, key in keys.items():
+        for name in backends.available(cipher):
+            backend = backends.get_backend(cipher, name)
+            for size in sizes[:1] if name == "reference" else sizes:
+                data = bytes(size)
+                for operation in ("encrypt", "decrypt"):
+                    yield Benchmark(
+                        f"{cipher}/backend-{name}/{operation}/{size}",
+                        lambda f=getattr(backend, operation), data=data: f(key, data),
+                        size,
+                    )
+
+
+# Multi-core ParallelAES, with the threshold at 0 so that every size goes
+# through the worker pool, and random-access CTR decryption
+def parallel_benchmarks(sizes: tuple[int, ...]) -> Iterator[Benchmark]:
+    key = bytes(range(16))
+    counter = bytes(16)
+    # The pool is shut down once the generator is exhausted
+    with parallel.ParallelAES(key, threshold=0) as cipher:
+        for size in sizes:
+            data = bytes(size)
+            yield Benchmark(
+                f"aes-128/parallel-ctr/{size}",
+                lambda data=data: cipher.crypt_ctr(counter, data),
+                size,
+            )
+            yield Benchmark(
+                f"aes-128/parallel-cbc-decrypt/{size}",
+                lambda data=data: cipher.decrypt_cbc(counter, data),
+                size,
+            )
+    for size in sizes:
+        # Without a cache every call generates the keystream
+        reader = ctr.CTRReader(key, counter, bytes(size + 1), cache_blocks=0)
+        yield Benchmark(
+            f"aes-128/ctr-read_range/{size}",
+            lambda reader=reader, size=size: reader.read_range(1, size),
+            size,
+        )
+
+
+# Engines that need NumPy, skipped when it is not installed
+def numpy_benchmarks(sizes: tuple[int, ...]) -> Iterator[Benchmark]:
+    try:
+        import numpy as np
+
+        import aes_bitslice
+        import aes_numpy
+        import des_bitslice
+        import xts
+    except ImportError:
+        return
+    key = bytes(range(16))
+    nr, rk, _ = aes.expand_key(key)
+    keys = np.frombuffer(bytes(range(256)) * 16, dtype=np.uint8).reshape(-1, 16)
+    yield Benchmark(
+        "aes-128/key_expansion_batch/256", lambda: aes_numpy.key_expansion_batch(keys)
+    )
+    yield Benchmark("xts/XTS", lambda: xts.XTS(bytes(range(32))))
+    xts_cipher = xts.XTS(bytes(range(32)))
+    for size in sizes:
+        blocks = np.zeros((size // 16, 16), dtype=np.uint8)
+        des_blocks = np.zeros((size // 8, 8), dtype=np.uint8)
+        data = bytes(size)
+        yield Benchmark(
+            f"aes-128/numpy/{size}",
+            lambda b=blocks: aes_numpy.encrypt_blocks(b, nr, rk),
+            size,
+        )
+        yield Benchmark(
+            f"aes-128/numpy-ctr/{size}",
+            lambda data=data: aes_numpy.ctr_crypt(key, bytes(16), data),
+            size,
+        )
+        yield Benchmark(
+            f"aes-128/bitslice/{size}",
+            lambda b=blocks: aes_bitslice.encrypt_blocks(b, nr, rk),
+            size,
+        )
+        yield Benchmark(
+            f"des/bitslice/{size}",
+            lambda b=des_blocks: des_bitslice.encrypt_blocks(b, bytes(8)),
+            size,
+        )
+        if size >= xts.SECTOR_SIZE:
+            yield Benchmark(
+                f"xts/encrypt_sectors/{size}",
+                lambda data=data: xts_cipher.encrypt_sectors(data),
+                size,
+            )
+            yield Benchmark(
+                f"xts/decrypt_sectors/{size}",
+                lambda data=data: xts_cipher.decrypt_sectors(data),
+                size,
+            )
+
+
+def all_benchmarks(sizes: tuple[int, ...] = SIZES) -> Iterator[Benchmark]:
+    yield from aes_benchmarks(sizes)
+    yield from des_benchmarks(sizes)
+    yield from mode_benchmarks(sizes)
+    yield from backends_benchmarks(sizes)
+    yield from parallel_benchmarks(sizes)
+    yield from numpy_benchmarks(sizes)
+
+
+# Seconds per call of func, one sample per repeat
+def measure(
+    func: Callable[[], object], repeat: int = REPEAT, min_time: float = MIN_TIME
+) -> tuple[int, list[float]]:
+    # The first call may build tables or fill caches
+    func()
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        # Aim slightly above min_time to avoid another round of calibration
+        loops = max(loops * 2, int(loops * 1.2 * min_time / max(elapsed, 1e-9)))
+    samples = [elapsed / loops]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        samples.append((time.perf_counter() - start) / loops)
+    return loops, samples
+
+
+def run(
+    benchmark: Benchmark, repeat: int = REPEAT, min_time: float = MIN_TIME
+) -> Result:
+    loops, samples = measure(benchmark.func, repeat, min_time)
+    median = statistics.median(samples)
+    return Result(
+        benchmark.name,
+        loops,
+        statistics.mean(samples),
+        median,
+        statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        1 / median,
+        benchmark.size / median / 1e6 if benchmark.size else None,
+    )
+
+
+# Benchmarks whose median time grew by more than threshold relative to the
+# baseline, as (name, baseline median, new median)
+def regressions(
+    results: dict[str, dict], baseline: dict[str, dict], threshold: float = THRESHOLD
+) -> list[tuple[str, float, float]]:
+    found = []
+    for name, result in results.items():
+        if name in baseline:
+            before = baseline[name]["median"]
+            if result["median"] > before * (1 + threshold):
+                found.append((name, before, result["median"]))
+    return found
+
+
+def format_result(result: Result) -> str:
+    rate = f"{result.mb_s:10.3f} MB/s" if result.mb_s is not None else " " * 15
+    return (
+        f"{result.name:<36} {result.median * 1e6:12.2f} us"
+        f" ±{result.stdev / result.median * 100:5.1f}%"
+        f" {result.ops:12.1f} ops/s {rate}"
+    )
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bench")
+    parser.add_argument("-k", dest="filter", help="run benchmarks containing this")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--min-time", type=float, default=MIN_TIME)
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    results = {}
+    for benchmark in all_benchmarks(tuple(args.sizes)):
+        if args.filter and args.filter not in benchmark.name:
+            continue
+        result = run(benchmark, args.repeat, args.min_time)
+        results[result.name] = result._asdict()
+        print(format_result(result), flush=True)
+
+    if args.output:
+        report = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        found = regressions(results, baseline, args.threshold)
+        for name, before, after in found:
+            print(
+                f"regression: {name} {before * 1e6:.2f} us -> {after * 1e6:.2f} us"
+                f" (+{(after / before - 1) * 100:.1f}%)",
+                file=sys.stderr,
+            )
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
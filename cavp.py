@@ -0,0 +1,410 @@
+# Runner for the NIST CAVP test vectors (.rsp files) of AES and TDES
+#
+# The response files are read from a directory tree and recognised by name:
+# 1) AESAVS: ECB and CBC known-answer (GFSbox, KeySbox, VarKey, VarTxt),
+#    multi-block message (MMT) and Monte Carlo (MCT) tests
+# 2) TDES: TECB and TCBC known-answer, MMT and Monte Carlo tests
+# 3) GCM: gcmEncryptExtIV and gcmDecrypt
+# 4) XTS: XTSGenAES128 and XTSGenAES256
+# Other files (CFB, OFB, interleaved TDES) are reported as skipped, as are
+# the XTS records whose data unit is not a whole number of bytes.
+#
+# ECB, CBC and the Monte Carlo tests are run on every engine of backends.py,
+# so the fast engines are tested against the same vectors as the reference
+# functions. GCM runs on the T-table engine it is built on and XTS on the
+# NumPy engine.
+#
+# Every record of a Monte Carlo file holds the inputs of its outer
+# iteration, so each record is checked on its own by running the inner loop
+# (1000 blocks for AES, 10000 for TDES) from the recorded key, IV and input.
+# The inner loop chains every block on the previous one, so it only uses
+# single-block calls; by default it runs on the table engine for the first
+# MCT_LIMIT records of each file.
+#
+# Independent test cases are spread over a process pool. The runner prints
+# pass/fail counts and the time spent per engine and exits with status 1 if
+# any test fails.
+#
+# Usage:
+# python -m cavp path/to/vectors
+# python -m cavp path/to/vectors --engines table numpy --mct-limit 0
+# python -m cavp path/to/vectors -k TECB --workers 4
+import argparse
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, NamedTuple, Optional
+
+import backends
+import des
+import gcm
+from filecrypt import xor_bytes
+
+# Monte Carlo records checked per file, 0 for all of them
+MCT_LIMIT = 10
+MCT_ENGINES = ("table",)
+# Test cases sent to a worker at a time
+BATCH_CASES = 64
+
+AES_FILE = re.compile(
+    r"^(ECB|CBC)(GFSbox|KeySbox|VarKey|VarTxt|MMT|MCT)(128|192|256)\.rsp$"
+)
+TDES_FILE = re.compile(
+    r"^T(ECB|CBC)(MMT[123]|Monte[123]|invperm|permop|subtab|varkey|vartext)\.rsp$"
+)
+GCM_FILE = re.compile(r"^gcm(EncryptExtIV|Decrypt)(128|192|256)\.rsp$")
+XTS_FILE = re.compile(r"^XTSGenAES(128|256)\.rsp$")
+
+
+class TestCase(NamedTuple):
+    path: str
+    # "aes", "tdes", "gcm" or "xts"
+    suite: str
+    mode: str
+    monte_carlo: bool
+    decrypt: bool
+    fields: dict[str, str]
+
+
+class Report(NamedTuple):
+    engine: str
+    passed: int
+    # (path, COUNT) of the failed cases
+    failed: list[tuple[str, str]]
+    seconds: float
+
+
+# Yields the records of a response file with the [ENCRYPT]/[DECRYPT] section
+# they belong to. Field names are upper-cased, a line without "=" (FAIL in
+# the GCM decryption files) is a field with an empty value
+def parse_rsp(path: str) -> Iterator[tuple[Optional[str], dict[str, str]]]:
+    section = None
+    fields: dict[str, str] = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                if fields:
+                    yield section, fields
+                    fields = {}
+                continue
+            if line.startswith("["):
+                name = line.strip("[]").strip()
+                if name in ("ENCRYPT", "DECRYPT"):
+                    section = name
+                continue
+            name, _, value = line.partition("=")
+            fields[name.strip().upper()] = value.strip()
+    if fields:
+        yield section, fields
+
+
+def classify(name: str) -> Optional[tuple[str, str, bool]]:
+    match = AES_FILE.match(name)
+    if match:
+        return "aes", match[1].lower(), match[2] == "MCT"
+    match = TDES_FILE.match(name)
+    if match:
+        return "tdes", match[1].lower(), match[2].startswith("Monte")
+    match = GCM_FILE.match(name)
+    if match:
+        return "gcm", "gcm", False
+    if XTS_FILE.match(name):
+        return "xts", "xts", False
+    return None
+
+
+# Returns the files that are not run, and the records of run files that are
+# not supported, as lines of the report
+def load(directory: str) -> tuple[list[TestCase], list[str]]:
+    cases = []
+    skipped = []
+    # XTS data units that are not a whole number of bytes, per file
+    partial_bytes: dict[str, int] = {}
+    for root, _, files in sorted(os.walk(directory)):
+        for name in sorted(files):
+            if not name.endswith(".rsp"):
+                continue
+            path = os.path.join(root, name)
+            kind = classify(name)
+            if kind is None:
+                skipped.append(path)
+                continue
+            suite, mode, monte_carlo = kind
+            for section, fields in parse_rsp(path):
+                if "COUNT" not in fields:
+                    continue
+                # The GCM files have no sections, decryption records have a
+                # CT and no section
+                decrypt = section == "DECRYPT" or name.startswith("gcmDecrypt")
+                if suite == "xts" and int(fields["DATAUNITLEN"]) % 8:
+                    partial_bytes[path] = partial_bytes.get(path, 0) + 1
+                    continue
+                cases.append(TestCase(path, suite, mode, monte_carlo, decrypt, fields))
+    for path, n in partial_bytes.items():
+        skipped.append(f"{path} ({n} records with a partial-byte data unit)")
+    return cases, skipped
+
+
+# ECB encryption and decryption of whole buffers with the given engine
+def ecb_functions(
+    engine: str, suite: str, fields: dict[str, str]
+) -> tuple[Callable[[bytes], bytes], Callable[[bytes], bytes], int]:
+    if suite == "aes":
+        backend = backends.get_backend("aes", engine)
+        key = bytes.fromhex(fields["KEY"])
+        return (
+            lambda data: backend.encrypt(key, data),
+            lambda data: backend.decrypt(key, data),
+            16,
+        )
+    if "KEYS" in fields:
+        k1 = k2 = k3 = bytes.fromhex(fields["KEYS"])
+    else:
+        k1, k2, k3 = (bytes.fromhex(fields[f"KEY{i}"]) for i in (1, 2, 3))
+    if engine == "table":
+        # The table engine has a dedicated 3DES with a single IP/FP
+        triple = des.TripleDES(k1, k2, k3)
+        return triple.encrypt_ecb, triple.decrypt_ecb, 8
+    backend = backends.get_backend("des", engine)
+    enc, dec = backend.encrypt, backend.decrypt
+    return (
+        lambda data: enc(k3, dec(k2, enc(k1, data))),
+        lambda data: dec(k1, enc(k2, dec(k3, data))),
+        8,
+    )
+
+
+def cbc_encrypt(encrypt: Callable, size: int, iv: bytes, data: bytes) -> bytes:
+    out = []
+    prev = iv
+    for i in range(0, len(data), size):
+        prev = encrypt(xor_bytes(data[i : i + size], prev))
+        out.append(prev)
+    return b"".join(out)
+
+
+def cbc_decrypt(decrypt: Callable, size: int, iv: bytes, data: bytes) -> bytes:
+    return xor_bytes(decrypt(data), iv + data[:-size])
+
+
+def check_block_mode(engine: str, case: TestCase) -> bool:
+    fields = case.fields
+    encrypt, decrypt, size = ecb_functions(engine, case.suite, fields)
+    plaintext = bytes.fromhex(fields["PLAINTEXT"])
+    ciphertext = bytes.fromhex(fields["CIPHERTEXT"])
+    iv = bytes.fromhex(fields.get("IV", ""))
+    if case.monte_carlo:
+        return check_monte_carlo(case, encrypt, decrypt, iv, plaintext, ciphertext)
+    if case.mode == "ecb":
+        if case.decrypt:
+            return decrypt(ciphertext) == plaintext
+        return encrypt(plaintext) == ciphertext
+    if case.decrypt:
+        return cbc_decrypt(decrypt, size, iv, ciphertext) == plaintext
+    return cbc_encrypt(encrypt, size, iv, plaintext) == ciphertext
+
+
+# Inner loop of the AESAVS and TDES Monte Carlo tests for one record. In ECB
+# every output is the next input. In CBC encryption the next input is the
+# previous chaining value (the IV, then the previous output block), which
+# turns the loop into x[j + 1] = y[j - 1]. CBC decryption follows the same
+# rule in AESAVS, while TDESVS feeds every plaintext block straight back as
+# the next ciphertext block: x[j + 1] = y[j]
+def check_monte_carlo(
+    case: TestCase,
+    encrypt: Callable,
+    decrypt: Callable,
+    iv: bytes,
+    plaintext: bytes,
+    ciphertext: bytes,
+) -> bool:
+    n = 1000 if case.suite == "aes" else 10000
+    crypt = decrypt if case.decrypt else encrypt
+    x, want = (ciphertext, plaintext) if case.decrypt else (plaintext, ciphertext)
+    if case.mode == "ecb":
+        for _ in range(n):
+            x = crypt(x)
+        return x == want
+    chain = iv
+    if case.decrypt:
+        prev = iv
+        for _ in range(n):
+            y = xor_bytes(crypt(x), chain)
+            if case.suite == "tdes":
+                chain, x = x, y
+            else:
+                chain, x, prev = x, prev, y
+        return y == want
+    for _ in range(n):
+        y = crypt(xor_bytes(x, chain))
+        x, chain = chain, y
+    return y == want
+
+
+def check_gcm(case: TestCase) -> bool:
+    fields = case.fields
+    key, iv, aad, tag = (
+        bytes.fromhex(fields[name]) for name in ("KEY", "IV", "AAD", "TAG")
+    )
+    if case.decrypt:
+        try:
+            plaintext = gcm.decrypt(key, iv, bytes.fromhex(fields["CT"]), tag, aad)
+        except gcm.InvalidTag:
+            return "FAIL" in fields
+        return "FAIL" not in fields and plaintext == bytes.fromhex(fields["PT"])
+    result = gcm.encrypt(key, iv, bytes.fromhex(fields["PT"]), aad, len(tag))
+    return result == (bytes.fromhex(fields["CT"]), tag)
+
+
+# xts needs NumPy, it is only imported by the numpy engine
+def check_xts(case: TestCase) -> bool:
+    import xts
+
+    fields = case.fields
+    if "I" in fields:
+        sector = int.from_bytes(bytes.fromhex(fields["I"]), "little")
+    else:
+        sector = int(fields["DATAUNITSEQNUMBER"])
+    cipher = xts.XTS(bytes.fromhex(fields["KEY"]))
+    plaintext = bytes.fromhex(fields["PT"])
+    ciphertext = bytes.fromhex(fields["CT"])
+    if case.decrypt:
+        return cipher.decrypt_sectors(ciphertext, sector, len(ciphertext)) == plaintext
+    return cipher.encrypt_sectors(plaintext, sector, len(plaintext)) == ciphertext
+
+
+# Runs in a worker process, returns the (path, COUNT) of the failed cases,
+# the number of cases run and the time taken
+def run_cases(
+    engine: str, cases: list[TestCase]
+) -> tuple[list[tuple[str, str]], int, float]:
+    start = time.perf_counter()
+    failed = []
+    run = 0
+    for case in cases:
+        try:
+            if case.suite == "gcm":
+                ok = check_gcm(case)
+            elif case.suite == "xts":
+                ok = check_xts(case)
+            else:
+                ok = check_block_mode(engine, case)
+        except Exception:
+            ok = False
+        run += 1
+        if not ok:
+            failed.append((case.path, case.fields["COUNT"]))
+    return failed, run, time.perf_counter() - start
+
+
+# Splits the cases of each engine into tasks. A Monte Carlo record is a task
+# of its own, other cases are sent in batches
+def make_tasks(
+    cases: list[TestCase],
+    engines: list[str],
+    mct_engines: list[str],
+    mct_limit: int,
+) -> Iterator[tuple[str, list[TestCase]]]:
+    for engine in engines:
+        batch: list[TestCase] = []
+        seen: dict[tuple[str, bool], int] = {}
+        for case in cases:
+            if case.suite == "gcm" and engine != "table":
+                continue
+            if case.suite == "xts" and engine != "numpy":
+                continue
+            if case.monte_carlo:
+                if engine not in mct_engines:
+                    continue
+                key = (case.path, case.decrypt)
+                seen[key] = seen.get(key, 0) + 1
+                if mct_limit and seen[key] > mct_limit:
+                    continue
+                yield engine, [case]
+                continue
+            batch.append(case)
+            if len(batch) == BATCH_CASES:
+                yield engine, batch
+                batch = []
+        if batch:
+            yield engine, batch
+
+
+def run(
+    directory: str,
+    engines: Optional[list[str]] = None,
+    mct_engines: tuple[str, ...] = MCT_ENGINES,
+    mct_limit: int = MCT_LIMIT,
+    workers: Optional[int] = None,
+    filter: Optional[str] = None,
+) -> tuple[dict[str, Report], list[str]]:
+    cases, skipped = load(directory)
+    if filter:
+        cases = [case for case in cases if filter in case.path]
+    engines = engines or backends.available("aes")
+    passed = {engine: 0 for engine in engines}
+    failed: dict[str, list[tuple[str, str]]] = {engine: [] for engine in engines}
+    seconds = {engine: 0.0 for engine in engines}
+    tasks = list(make_tasks(cases, engines, list(mct_engines), mct_limit))
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [
+            (engine, pool.submit(run_cases, engine, batch)) for engine, batch in tasks
+        ]
+        for engine, future in futures:
+            failures, count, elapsed = future.result()
+            passed[engine] += count - len(failures)
+            failed[engine] += failures
+            seconds[engine] += elapsed
+    reports = {
+        engine: Report(engine, passed[engine], failed[engine], seconds[engine])
+        for engine in engines
+    }
+    return reports, skipped
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m cavp")
+    parser.add_argument("directory", help="directory searched for .rsp files")
+    parser.add_argument("--engines", nargs="+", choices=backends.ENGINES)
+    parser.add_argument(
+        "--mct-engines", nargs="+", choices=backends.ENGINES, default=MCT_ENGINES
+    )
+    parser.add_argument(
+        "--mct-limit",
+        type=int,
+        default=MCT_LIMIT,
+        help="Monte Carlo records checked per file, 0 for all",
+    )
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("-k", dest="filter", help="run files whose path contains this")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    reports, skipped = run(
+        args.directory,
+        args.engines,
+        args.mct_engines,
+        args.mct_limit,
+        args.workers,
+        args.filter,
+    )
+    elapsed = time.perf_counter() - start
+    for path in skipped:
+        print(f"skipped: {path}")
+    print(f"{'engine':<10} {'passed':>8} {'failed':>8} {'cpu s':>10}")
+    for report in reports.values():
+        print(
+            f"{report.engine:<10} {report.passed:>8} {len(report.failed):>8}"
+            f" {report.seconds:>10.2f}"
+        )
+        for path, count in report.failed:
+            print(f"  FAIL {path} COUNT = {count}")
+    print(f"{elapsed:.2f} s")
+    return 1 if any(report.failed for report in reports.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
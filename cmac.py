@@ -0,0 +1,138 @@
+# AES-CMAC, a hashlib-style incremental message authentication code
+# Reference:
+# https://nvlpubs.nist.gov/nistpubs/SpecialPublications/NIST.SP.800-38b.pdf
+#
+# CMAC is CBC-MAC with a zero IV where the last block is XORed with one of two
+# subkeys before it is encrypted: K1 when the block is complete, K2 when it
+# had to be padded with 10...0. Both are derived from L = CIPH(K, 0^128) by
+# doubling in GF(2^128) and are cached per key with the key schedule.
+#
+# The chaining value is kept as the 4 column words of aes.encrypt_words(), so
+# update() feeds whole chunks through struct.iter_unpack() without building
+# an intermediate bytes object per block. Since the last block of the
+# message is processed differently, the state always holds back the last
+# (possibly full) block until digest().
+from array import array
+from functools import lru_cache
+from typing import Optional
+
+import aes
+
+BLOCK_SIZE = 16
+MASK_128 = (1 << 128) - 1
+# x^128 + x^7 + x^2 + x + 1
+R = 0x87
+
+
+# Multiplication by x in GF(2^128), the block read as a big-endian integer
+def gf_double(v: int) -> int:
+    v <<= 1
+    return (v ^ R) & MASK_128 if v >> 128 else v
+
+
+@lru_cache(maxsize=256)
+def cmac_key(key: bytes) -> tuple[int, array, tuple[int, ...], tuple[int, ...]]:
+    nr, rk, _ = aes.key_schedule_cache.get(key)
+    words = aes.block_words
+    l = int.from_bytes(words.pack(*aes.encrypt_words(0, 0, 0, 0, nr, rk)), "big")
+    k1 = gf_double(l)
+    k2 = gf_double(k1)
+    return (
+        nr,
+        rk,
+        words.unpack(k1.to_bytes(16, "big")),
+        words.unpack(k2.to_bytes(16, "big")),
+    )
+
+
+class CMAC:
+    name = "aes-cmac"
+    digest_size = 16
+    block_size = 16
+
+    def __init__(self, key: bytes, data: Optional[bytes] = None):
+        self.nr, self.rk, self.k1, self.k2 = cmac_key(bytes(key))
+        self.state = (0, 0, 0, 0)
+        self.pending = b""
+        if data is not None:
+            self.update(data)
+
+    # Encrypts the blocks of data, a multiple of 16 bytes, into the chaining
+    # value
+    def absorb(self, data) -> None:
+        nr, rk, encrypt = self.nr, self.rk, aes.encrypt_words
+        s0, s1, s2, s3 = self.state
+        for w0, w1, w2, w3 in aes.block_words.iter_unpack(data):
+            s0, s1, s2, s3 = encrypt(s0 ^ w0, s1 ^ w1, s2 ^ w2, s3 ^ w3, nr, rk)
+        self.state = (s0, s1, s2, s3)
+
+    def update(self, data) -> None:
+        with memoryview(data) as view, view.cast("B") as data:
+            if not data:
+                return
+            start = 0
+            if self.pending:
+                # The pending block can only be absorbed once it is known not
+                # to be the last one
+                start = BLOCK_SIZE - len(self.pending)
+                self.pending += bytes(data[:start])
+                if start >= len(data):
+                    return
+                self.absorb(self.pending)
+            # Keep the last 1 to 16 bytes for the next call or digest()
+            end = len(data) - ((len(data) - start - 1) % BLOCK_SIZE + 1)
+            self.absorb(data[start:end])
+            self.pending = bytes(data[end:])
+
+    def copy(self) -> "CMAC":
+        other = object.__new__(CMAC)
+        other.nr, other.rk, other.k1, other.k2 = self.nr, self.rk, self.k1, self.k2
+        other.state = self.state
+        other.pending = self.pending
+        return other
+
+    def digest(self) -> bytes:
+        if len(self.pending) == BLOCK_SIZE:
+            last, k = self.pending, self.k1
+        else:
+            last = self.pending + b"\x80" + bytes(BLOCK_SIZE - 1 - len(self.pending))
+            k = self.k2
+        w0, w1, w2, w3 = aes.block_words.unpack(last)
+        s0, s1, s2, s3 = self.state
+        return aes.block_words.pack(
+            *aes.encrypt_words(
+                s0 ^ w0 ^ k[0],
+                s1 ^ w1 ^ k[1],
+                s2 ^ w2 ^ k[2],
+                s3 ^ w3 ^ k[3],
+                self.nr,
+                self.rk,
+            )
+        )
+
+    def hexdigest(self) -> str:
+        return self.digest().hex()
+
+
+# Checks the examples of RFC 4493, run with python -m cmac
+def selftest() -> None:
+    # Examples from RFC 4493 section 4
+    key = bytes.fromhex("2b7e151628aed2a6abf7158809cf4f3c")
+    message = bytes.fromhex(
+        "6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51"
+        "30c81c46a35ce411e5fbc1191a0a52eff69f2445df4f9b17ad2b417be66c3710"
+    )
+    assert CMAC(key).hexdigest() == "bb1d6929e95937287fa37d129b756746"
+    assert CMAC(key, message[:16]).hexdigest() == "070a16b46b4d4144f79bdd9dd04a287c"
+    assert CMAC(key, message[:40]).hexdigest() == "dfa66747de9ae63030ca32611497c827"
+    assert CMAC(key, message).hexdigest() == "51f0bebf7e3b9d92fc49741779363cfe"
+    mac = CMAC(key, message[:7])
+    checkpoint = mac.copy()
+    mac.update(message[7:])
+    checkpoint.update(message[7:40])
+    assert mac.hexdigest() == "51f0bebf7e3b9d92fc49741779363cfe"
+    assert checkpoint.hexdigest() == "dfa66747de9ae63030ca32611497c827"
+
+
+if __name__ == "__main__":
+    selftest()
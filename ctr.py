@@ -0,0 +1,156 @@
+# Random-access AES-CTR decryption
+#
+# In counter mode block i of the ciphertext only depends on block i of the
+# keystream, E(K, counter + i). A byte range [offset, offset + length) can
+# therefore be decrypted by generating only the keystream blocks
+# offset // 16 to (offset + length - 1) // 16, independently of the size of
+# the object and of what was read before.
+#
+# CTRReader wraps a seekable file of ciphertext (or a bytes-like object) as
+# a read-only, seekable file of plaintext. Recently generated keystream
+# blocks are kept in a bounded LRU cache, so overlapping reads do not
+# encrypt the same counter blocks again.
+import io
+from collections import OrderedDict
+from typing import Optional
+
+import aes
+
+BLOCK_SIZE = 16
+# Number of keystream blocks kept by default, 64 KB of keystream
+CACHE_BLOCKS = 4096
+
+
+class CTRReader(io.RawIOBase):
+    def __init__(
+        self, key: bytes, counter: bytes, source, cache_blocks: int = CACHE_BLOCKS
+    ):
+        super().__init__()
+        if len(counter) != BLOCK_SIZE:
+            raise ValueError(f"invalid counter block length: {len(counter)} bytes")
+        self.cipher = aes.AES(key)
+        self.counter = int.from_bytes(counter, "big")
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        self.source = source
+        self.size = source.seek(0, io.SEEK_END)
+        self.position = 0
+        self.cache_blocks = cache_blocks
+        self.cache: OrderedDict[int, bytes] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"negative seek position: {position}")
+        self.position = position
+        return position
+
+    def keystream_block(self, index: int) -> bytes:
+        block = self.cache.get(index)
+        if block is not None:
+            self.cache.move_to_end(index)
+            self.hits += 1
+            return block
+        self.misses += 1
+        counter = (self.counter + index) % (1 << 128)
+        block = self.cipher.encrypt_block(counter.to_bytes(BLOCK_SIZE, "big"))
+        if self.cache_blocks:
+            self.cache[index] = block
+            if len(self.cache) > self.cache_blocks:
+                self.cache.popitem(last=False)
+        return block
+
+    # Keystream bytes for [offset, offset + length)
+    def keystream(self, offset: int, length: int) -> bytes:
+        first = offset // BLOCK_SIZE
+        last = (offset + length - 1) // BLOCK_SIZE
+        stream = b"".join(self.keystream_block(i) for i in range(first, last + 1))
+        start = offset - first * BLOCK_SIZE
+        return stream[start : start + length]
+
+    # Decrypts [offset, offset + length) without moving the read position,
+    # the range is cut off at the end of the object
+    def read_range(self, offset: int, length: int) -> bytes:
+        length = max(0, min(length, self.size - offset))
+        if not length:
+            return b""
+        self.source.seek(offset)
+        data = self.source.read(length)
+        keystream = self.keystream(offset, len(data))
+        return (
+            int.from_bytes(data, "big") ^ int.from_bytes(keystream, "big")
+        ).to_bytes(len(data), "big")
+
+    def readinto(self, b) -> int:
+        with memoryview(b) as view, view.cast("B") as out:
+            data = self.read_range(self.position, len(out))
+            out[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def readall(self) -> bytes:
+        data = self.read_range(self.position, self.size - self.position)
+        self.position += len(data)
+        return data
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        if size is None or size < 0:
+            return self.readall()
+        data = self.read_range(self.position, size)
+        self.position += len(data)
+        return data
+
+
+# SP 800-38A F.5.2 (CTR-AES128 decryption), read back at offsets and with
+# lengths that are not block-aligned, through read, readinto and seek
+def selftest() -> None:
+    key = bytes.fromhex("2b7e151628aed2a6abf7158809cf4f3c")
+    counter = bytes.fromhex("f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff")
+    plaintext = bytes.fromhex(
+        "6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51"
+        "30c81c46a35ce411e5fbc1191a0a52eff69f2445df4f9b17ad2b417be66c3710"
+    )
+    ciphertext = bytes.fromhex(
+        "874d6191b620e3261bef6864990db6ce9806f66b7970fdff8617187bb9fffdff"
+        "5ae4df3edbd5d35e5b4f09020db03eab1e031dda2fbe03d1792170a0f3009cee"
+    )
+    for cache_blocks in (CACHE_BLOCKS, 1, 0):
+        reader = CTRReader(key, counter, ciphertext, cache_blocks)
+        assert reader.read() == plaintext
+        assert reader.read(5) == b""
+        for offset in (0, 1, 15, 17, 31, 47, 63):
+            for length in (1, 5, 16, 33, 100):
+                want = plaintext[offset : offset + length]
+                assert reader.read_range(offset, length) == want
+                assert reader.seek(offset) == offset
+                assert reader.read(length) == want
+                assert reader.tell() == offset + len(want)
+                reader.seek(offset)
+                out = bytearray(length)
+                assert reader.readinto(out) == len(want)
+                assert out[: len(want)] == want
+        reader.seek(-20, io.SEEK_END)
+        reader.seek(3, io.SEEK_CUR)
+        assert reader.read() == plaintext[-17:]
+
+
+if __name__ == "__main__":
+    selftest()
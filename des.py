@@ -1,6 +1,8 @@
 # Data Encryption Standard (DES)
 # Reference:
 # https://page.math.tu-berlin.de/~kant/teaching/hess/krypto-ws2006/des.htm
+import struct
+import timeit
 from typing import List, Tuple
 
 # DES is a block cipher - operates on plaintext blocks of 64 bits
@@ -125,6 +127,8 @@ s8 = (
     (2, 1, 14, 7, 4, 10, 8, 13, 15, 12, 9, 0, 3, 5, 6, 11),
 )
 
+s_tables = (s1, s2, s3, s4, s5, s6, s7, s8)
+
 # P yields a 32-bit output from a 32-bit input by permuting the bits
 # of the input block
 p = (
@@ -138,6 +142,9 @@ p = (
     (22, 11, 4, 25),
 )
 
+# Number of left shifts applied to Cn-1 and Dn-1 to form Cn and Dn
+shifts = (1, 1, 2, 2, 2, 2, 2, 2, 1, 2, 2, 2, 2, 2, 2, 1)
+
 ip_inverse = (
     (40, 8, 48, 16, 56, 24, 64, 32),
     (39, 7, 47, 15, 55, 23, 63, 31),
@@ -183,7 +190,6 @@ def generate_subkeys(key_bits: Block) -> list[Block]:
     #
     # To do a left shift, move each bit one place to the left, except
     # for the first bit, which is cycled to the end of the block
-    shifts = (1, 1, 2, 2, 2, 2, 2, 2, 1, 2, 2, 2, 2, 2, 2, 1)
     for i in range(ROUNDS):
         # Obtain Cn and Dn from Cn-1 and Dn-1 by left shifting
         # c[i] and d[i] represent Cn-1 and Dn-1 respectively
@@ -231,7 +237,6 @@ def feistel(block: Block, subkey: Block) -> Block:
     # a 6-bit block as input and yields a 4-bit block as output
     f_s = []
     curr = 0
-    s_tables = (s1, s2, s3, s4, s5, s6, s7, s8)
     for s in s_tables:
         block = f_x[curr : curr + 6]
         f_s += substitute(block, s)
@@ -289,14 +294,397 @@ def des_decrypt(ciphertext: int, key: int) -> Block:
     return permute(plaintext, ip_inverse)
 
 
-# Key should be of 64 bits
-key = 0x133457799BBCDFF1
-# Message should be in blocks of 64 bit, if less than that it should
-# be padded with zeores
-message = 0x74616E7573687269
+# The functions above represent blocks as lists of bits. The following
+# engine keeps blocks as Python ints instead: L and R are 32-bit ints and
+# the subkeys are 48-bit ints, with the first bit of a table being the most
+# significant bit.
+#
+# permute_int applies a permutation table to an int of in_width bits
+def permute_int(x: int, table: BoxType, in_width: int) -> int:
+    out = 0
+    for row in table:
+        for index in row:
+            out = (out << 1) | ((x >> (in_width - index)) & 1)
+    return out
+
+
+# A permutation is linear over the bits of its input, so its output is the
+# OR of the outputs for each input byte taken on its own. compile_permutation
+# turns a table into one 256-entry lookup table per input byte, the j-th
+# table being indexed by bits 8j to 8j + 7 counted from the least
+# significant bit. Applying the permutation then takes one lookup and OR per
+# input byte instead of one step per output bit
+PermutationTables = Tuple[Tuple[int, ...], ...]
+
+
+def compile_permutation(table: BoxType, in_width: int) -> PermutationTables:
+    return tuple(
+        tuple(permute_int(b << (8 * j), table, in_width) for b in range(256))
+        for j in range((in_width + 7) // 8)
+    )
+
+
+def apply_permutation(x: int, tables: PermutationTables) -> int:
+    out = 0
+    for table in tables:
+        out |= table[x & 0xFF]
+        x >>= 8
+    return out
+
+
+# Same as apply_permutation, unrolled for the 64-bit permutations IP and IP^-1
+def apply_permutation_64(x: int, tables: PermutationTables) -> int:
+    t0, t1, t2, t3, t4, t5, t6, t7 = tables
+    # fmt: off
+    return (
+        t0[x & 0xFF] | t1[x >> 8 & 0xFF] | t2[x >> 16 & 0xFF] | t3[x >> 24 & 0xFF]
+        | t4[x >> 32 & 0xFF] | t5[x >> 40 & 0xFF] | t6[x >> 48 & 0xFF] | t7[x >> 56]
+    )
+    # fmt: on
+
+
+# The S-boxes and the permutation P are combined into SP tables. For the
+# i-th group of 6 bits B, sp_tables[i][B] is P applied to the 32-bit block
+# that has Si(B) in bits 4i + 1 to 4i + 4 and zeros elsewhere, so that
+#
+# f(R, K) = P(S1(B1)...S8(B8)) = sp_tables[0][B1] ⊕ ... ⊕ sp_tables[7][B8]
+def make_sp_tables() -> tuple[tuple[int, ...], ...]:
+    tables = []
+    for i, s in enumerate(s_tables):
+        table = []
+        for b in range(64):
+            # Outer bits select the row, the middle 4 bits the column
+            value = s[(b >> 4 & 2) | (b & 1)][b >> 1 & 0xF]
+            table.append(apply_permutation(value << (28 - 4 * i), p_tables))
+        tables.append(tuple(table))
+    return tuple(tables)
+
+
+# The compiled tables take tens of milliseconds to build, so they are built
+# on first use rather than on import. Every path into the int engine starts
+# with generate_subkeys_int(), which builds them, and other modules reading
+# des.ip_tables go through the module __getattr__()
+COMPILED_TABLES = (
+    "ip_tables",
+    "ip_inverse_tables",
+    "pc1_tables",
+    "pc2_tables",
+    "e_tables",
+    "p_tables",
+    "sp_tables",
+)
+
+
+def build_tables() -> None:
+    global ip_tables, ip_inverse_tables, pc1_tables, pc2_tables, e_tables
+    global p_tables, sp_tables
+    if "sp_tables" in globals():
+        return
+    ip_tables = compile_permutation(ip, 64)
+    ip_inverse_tables = compile_permutation(ip_inverse, 64)
+    pc1_tables = compile_permutation(pc1, 64)
+    pc2_tables = compile_permutation(pc2, 56)
+    e_tables = compile_permutation(e_table, 32)
+    p_tables = compile_permutation(p, 32)
+    sp_tables = make_sp_tables()
+
+
+def __getattr__(name: str):
+    if name in COMPILED_TABLES:
+        build_tables()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Same steps as generate_subkeys, with C and D as 28-bit ints
+def generate_subkeys_int(key: int) -> list[int]:
+    build_tables()
+    key_plus = apply_permutation_64(key, pc1_tables)
+    c, d = key_plus >> 28, key_plus & 0xFFFFFFF
+    subkeys = []
+    for shift in shifts:
+        c = ((c << shift) | (c >> (28 - shift))) & 0xFFFFFFF
+        d = ((d << shift) | (d >> (28 - shift))) & 0xFFFFFFF
+        subkeys.append(apply_permutation((c << 28) | d, pc2_tables))
+    return subkeys
 
-ciphertext = des_encrypt(message, key)
-assert 0x1C43A6059EAD0F58 == bin_to_dec(ciphertext)
 
-plaintext = des_decrypt(bin_to_dec(ciphertext), key)
-assert message == bin_to_dec(plaintext)
+# The E-bit selection only duplicates bits at the group boundaries. Group i
+# of E(R) is bits 4i to 4i + 5 of R (1-based, wrapping around), which are
+# read directly from R rotated right by 1 bit, so E(R) is never built
+def des_rounds_int(l: int, r: int, subkeys: list[int]) -> int:
+    sp0, sp1, sp2, sp3, sp4, sp5, sp6, sp7 = sp_tables
+    for k in subkeys:
+        rr = ((r >> 1) | (r << 31)) & 0xFFFFFFFF
+        # fmt: off
+        f = (
+            sp0[(rr >> 26 ^ k >> 42) & 0x3F] ^ sp1[(rr >> 22 ^ k >> 36) & 0x3F]
+            ^ sp2[(rr >> 18 ^ k >> 30) & 0x3F] ^ sp3[(rr >> 14 ^ k >> 24) & 0x3F]
+            ^ sp4[(rr >> 10 ^ k >> 18) & 0x3F] ^ sp5[(rr >> 6 ^ k >> 12) & 0x3F]
+            ^ sp6[(rr >> 2 ^ k >> 6) & 0x3F] ^ sp7[(r << 1 ^ r >> 31 ^ k) & 0x3F]
+        )
+        # fmt: on
+        l, r = r, l ^ f
+    # R16L16
+    return (r << 32) | l
+
+
+def des_crypt_int(block: int, subkeys: list[int]) -> int:
+    x = apply_permutation_64(block, ip_tables)
+    x = des_rounds_int(x >> 32, x & 0xFFFFFFFF, subkeys)
+    return apply_permutation_64(x, ip_inverse_tables)
+
+
+def des_encrypt_int(message: int, key: int) -> int:
+    return des_crypt_int(message, generate_subkeys_int(key))
+
+
+def des_decrypt_int(ciphertext: int, key: int) -> int:
+    return des_crypt_int(ciphertext, generate_subkeys_int(key)[::-1])
+
+
+# A block of 8 bytes read as a big-endian 64-bit int
+block_int = struct.Struct(">Q")
+
+
+# Applies crypt to every block of src and writes the results into dst, both
+# being objects that support the buffer protocol. Blocks are read from and
+# written to the buffers directly and dst may be src. Returns the number of
+# bytes processed
+def crypt_into(dst, src, crypt, subkeys) -> int:
+    with memoryview(src) as src_mv, memoryview(dst) as dst_mv:
+        if dst_mv.readonly:
+            raise TypeError("dst must be a writable buffer")
+        with src_mv.cast("B") as src_view, dst_mv.cast("B") as dst_view:
+            n = len(src_view)
+            if n % 8:
+                raise ValueError("src length must be a multiple of 8 bytes")
+            if len(dst_view) < n:
+                raise ValueError("dst is smaller than src")
+            for offset in range(0, n, 8):
+                (x,) = block_int.unpack_from(src_view, offset)
+                block_int.pack_into(dst_view, offset, crypt(x, subkeys))
+    return n
+
+
+def check_block(block: bytes) -> None:
+    if len(block) != 8:
+        raise ValueError(f"invalid DES block length: {len(block)} bytes")
+
+
+def check_data(data: bytes) -> None:
+    if len(data) % 8:
+        raise ValueError("data length must be a multiple of 8 bytes")
+
+
+# DES instance for a single 8-byte key, the subkeys for encryption and
+# decryption are generated once and reused for every block
+class DES:
+    block_size = 8
+
+    def __init__(self, key: bytes):
+        if len(key) != 8:
+            raise ValueError(f"invalid DES key length: {len(key)} bytes")
+        self.subkeys = generate_subkeys_int(int.from_bytes(key, "big"))
+        self.inv_subkeys = self.subkeys[::-1]
+
+    def encrypt_block(self, block: bytes) -> bytes:
+        check_block(block)
+        return des_crypt_int(int.from_bytes(block, "big"), self.subkeys).to_bytes(
+            8, "big"
+        )
+
+    def decrypt_block(self, block: bytes) -> bytes:
+        check_block(block)
+        return des_crypt_int(int.from_bytes(block, "big"), self.inv_subkeys).to_bytes(
+            8, "big"
+        )
+
+    def encrypt_into(self, dst, src) -> int:
+        return crypt_into(dst, src, des_crypt_int, self.subkeys)
+
+    def decrypt_into(self, dst, src) -> int:
+        return crypt_into(dst, src, des_crypt_int, self.inv_subkeys)
+
+
+# Triple DES in EDE mode, C = E(k3, D(k2, E(k1, P))) and
+# P = D(k1, E(k2, D(k3, C))).
+#
+# The final permutation of one stage is immediately undone by the initial
+# permutation of the next, so the 48 rounds run between a single IP and a
+# single IP^-1, with only the R16L16 swap remaining between the stages. The
+# subkeys of every stage are generated once, in the order they are applied
+# for encryption and for decryption
+class TripleDES:
+    block_size = 8
+
+    def __init__(self, k1: bytes, k2: bytes, k3: bytes):
+        for k in (k1, k2, k3):
+            if len(k) != 8:
+                raise ValueError(f"invalid DES key length: {len(k)} bytes")
+        subkeys = [generate_subkeys_int(int.from_bytes(k, "big")) for k in (k1, k2, k3)]
+        inv_subkeys = [keys[::-1] for keys in subkeys]
+        self.encrypt_schedule = (subkeys[0], inv_subkeys[1], subkeys[2])
+        self.decrypt_schedule = (inv_subkeys[2], subkeys[1], inv_subkeys[0])
+
+    # A 24-byte key is k1 k2 k3, a 16-byte key is k1 k2 with k3 = k1
+    @classmethod
+    def from_key(cls, key: bytes) -> "TripleDES":
+        if len(key) not in (16, 24):
+            raise ValueError(f"invalid 3DES key length: {len(key)} bytes")
+        return cls(key[:8], key[8:16], key[16:] if len(key) == 24 else key[:8])
+
+    def crypt_int(self, block: int, schedule: tuple[list[int], ...]) -> int:
+        x = apply_permutation_64(block, ip_tables)
+        for subkeys in schedule:
+            # des_rounds_int returns R16L16, which is L0R0 of the next stage
+            x = des_rounds_int(x >> 32, x & 0xFFFFFFFF, subkeys)
+        return apply_permutation_64(x, ip_inverse_tables)
+
+    def encrypt_block(self, block: bytes) -> bytes:
+        check_block(block)
+        x = int.from_bytes(block, "big")
+        return self.crypt_int(x, self.encrypt_schedule).to_bytes(8, "big")
+
+    def decrypt_block(self, block: bytes) -> bytes:
+        check_block(block)
+        x = int.from_bytes(block, "big")
+        return self.crypt_int(x, self.decrypt_schedule).to_bytes(8, "big")
+
+    def encrypt_into(self, dst, src) -> int:
+        return crypt_into(dst, src, self.crypt_int, self.encrypt_schedule)
+
+    def decrypt_into(self, dst, src) -> int:
+        return crypt_into(dst, src, self.crypt_int, self.decrypt_schedule)
+
+    # ECB and CBC over data whose length is a multiple of 8 bytes, padding
+    # is left to the caller
+    def encrypt_ecb(self, data: bytes) -> bytes:
+        check_data(data)
+        schedule = self.encrypt_schedule
+        return b"".join(
+            block_int.pack(self.crypt_int(x, schedule))
+            for (x,) in block_int.iter_unpack(data)
+        )
+
+    def decrypt_ecb(self, data: bytes) -> bytes:
+        check_data(data)
+        schedule = self.decrypt_schedule
+        return b"".join(
+            block_int.pack(self.crypt_int(x, schedule))
+            for (x,) in block_int.iter_unpack(data)
+        )
+
+    def encrypt_cbc(self, iv: bytes, data: bytes) -> bytes:
+        if len(iv) != 8:
+            raise ValueError(f"invalid IV length: {len(iv)} bytes")
+        check_data(data)
+        schedule = self.encrypt_schedule
+        (prev,) = block_int.unpack(iv)
+        out = []
+        for (x,) in block_int.iter_unpack(data):
+            prev = self.crypt_int(x ^ prev, schedule)
+            out.append(block_int.pack(prev))
+        return b"".join(out)
+
+    def decrypt_cbc(self, iv: bytes, data: bytes) -> bytes:
+        if len(iv) != 8:
+            raise ValueError(f"invalid IV length: {len(iv)} bytes")
+        check_data(data)
+        schedule = self.decrypt_schedule
+        (prev,) = block_int.unpack(iv)
+        out = []
+        for (x,) in block_int.iter_unpack(data):
+            out.append(block_int.pack(self.crypt_int(x, schedule) ^ prev))
+            prev = x
+        return b"".join(out)
+
+
+# Cost of a single application of each permutation, using lists of bits
+# (permute), bit by bit on ints (permute_int) and the compiled byte tables
+# (apply_permutation)
+def benchmark_permutations(number: int = 20000) -> None:
+    build_tables()
+    print(f"{'table':<12} {'permute':>10} {'int':>10} {'compiled':>10}  (ns)")
+    for name, table, in_width, tables in (
+        ("ip", ip, 64, ip_tables),
+        ("ip_inverse", ip_inverse, 64, ip_inverse_tables),
+        ("pc1", pc1, 64, pc1_tables),
+        ("pc2", pc2, 56, pc2_tables),
+        ("e_table", e_table, 32, e_tables),
+        ("p", p, 32, p_tables),
+    ):
+        x = 0x0123456789ABCDEF & ((1 << in_width) - 1)
+        bits = hex_to_bin(x)[BLOCK_SIZE - in_width :]
+        timings = (
+            timeit.timeit(lambda: permute(bits, table), number=number),
+            timeit.timeit(lambda: permute_int(x, table, in_width), number=number),
+            timeit.timeit(lambda: apply_permutation(x, tables), number=number),
+        )
+        before, as_int, after = (t / number * 1e9 for t in timings)
+        print(f"{name:<12} {before:>10.0f} {as_int:>10.0f} {after:>10.0f}")
+
+
+# Known-answer tests of the reference functions, the int engine and 3DES,
+# run with python -m des
+def selftest() -> None:
+    # Key should be of 64 bits
+    key = 0x133457799BBCDFF1
+    # Message should be in blocks of 64 bit, if less than that it should
+    # be padded with zeores
+    message = 0x74616E7573687269
+
+    ciphertext = des_encrypt(message, key)
+    assert 0x1C43A6059EAD0F58 == bin_to_dec(ciphertext)
+
+    plaintext = des_decrypt(bin_to_dec(ciphertext), key)
+    assert message == bin_to_dec(plaintext)
+
+    assert des_encrypt_int(message, key) == bin_to_dec(ciphertext)
+    assert des_decrypt_int(bin_to_dec(ciphertext), key) == message
+
+    block_cipher = DES(key.to_bytes(8, "big"))
+    encrypted = block_cipher.encrypt_block(message.to_bytes(8, "big"))
+    assert 0x1C43A6059EAD0F58 == int.from_bytes(encrypted, "big")
+    assert message == int.from_bytes(block_cipher.decrypt_block(encrypted), "big")
+
+    # 3DES with k1 = k2 = k3 reduces to single DES
+    triple_des = TripleDES(*[key.to_bytes(8, "big")] * 3)
+    assert triple_des.encrypt_block(message.to_bytes(8, "big")) == encrypted
+    assert triple_des.decrypt_block(encrypted) == message.to_bytes(8, "big")
+
+    k1, k2, k3 = 0x0123456789ABCDEF, 0x23456789ABCDEF01, 0x456789ABCDEF0123
+    triple_des = TripleDES(*(k.to_bytes(8, "big") for k in (k1, k2, k3)))
+    ede = des_encrypt_int(des_decrypt_int(des_encrypt_int(message, k1), k2), k3)
+    encrypted = triple_des.encrypt_ecb(message.to_bytes(8, "big"))
+    assert ede == int.from_bytes(encrypted, "big")
+    assert triple_des.decrypt_ecb(encrypted) == message.to_bytes(8, "big")
+
+    buffer = bytearray(message.to_bytes(8, "big"))
+    triple_des.encrypt_into(buffer, buffer)
+    assert buffer == encrypted
+    triple_des.decrypt_into(buffer, buffer)
+    assert int.from_bytes(buffer, "big") == message
+
+    # Blocks, data and IVs of the wrong length are rejected
+    for call in (
+        lambda: block_cipher.encrypt_block(bytes(7)),
+        lambda: block_cipher.decrypt_block(bytes(9)),
+        lambda: triple_des.encrypt_block(bytes(7)),
+        lambda: triple_des.decrypt_block(bytes(9)),
+        lambda: triple_des.encrypt_ecb(bytes(12)),
+        lambda: triple_des.decrypt_ecb(bytes(12)),
+        lambda: triple_des.encrypt_cbc(bytes(8), bytes(12)),
+        lambda: triple_des.decrypt_cbc(bytes(16), bytes(16)),
+    ):
+        try:
+            call()
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("input of the wrong length was accepted")
+
+
+if __name__ == "__main__":
+    selftest()
+    benchmark_permutations()
@@ -0,0 +1,127 @@
+# Bitsliced DES using NumPy
+#
+# A batch of blocks is transposed into 64 bit-planes, plane i holds bit i + 1
+# (in the numbering of the DES tables) of every block, with 64 blocks packed
+# into each uint64 word. Every bitwise operation on a plane then computes
+# the same step of the cipher for 64 blocks at once.
+#
+# In this representation IP, IP^-1, E and P are only a reordering of the
+# planes, the subkeys are XORed in as planes of all zeros or all ones, and
+# the S-boxes are evaluated as boolean circuits. The circuit of an S-box is
+# derived from its table: the 64 minterms of the 6 input bits are built with
+# AND gates, and each of the 4 output bits is the XOR of the minterms for
+# which that bit of the table is set (at most one minterm is set for any
+# input, so XOR acts as OR). The same gates are evaluated for the 8 S-boxes
+# at once.
+from functools import lru_cache
+
+import numpy as np
+
+import des
+
+BLOCK_SIZE = 8
+ALL_ONES = np.uint64(0xFFFFFFFFFFFFFFFF)
+# Blocks per batch, large batches are split so that the planes and the
+# minterms stay in cache
+BATCH_BLOCKS = 1 << 14
+
+
+def table_indices(table: des.BoxType) -> list[int]:
+    return [index - 1 for row in table for index in row]
+
+
+ip_index = table_indices(des.ip)
+ip_inverse_index = table_indices(des.ip_inverse)
+e_index = table_indices(des.e_table)
+p_index = table_indices(des.p)
+
+
+# outputs[i, j, m] is set when bit j (0 being the most significant) of the
+# output of S-box i + 1 for the input m is set
+def sbox_outputs() -> np.ndarray:
+    outputs = np.zeros((8, 4, 64), dtype=bool)
+    for i, s in enumerate(des.s_tables):
+        for m in range(64):
+            value = s[(m >> 4 & 2) | (m & 1)][m >> 1 & 0xF]
+            for j in range(4):
+                outputs[i, j, m] = value >> (3 - j) & 1
+    return outputs
+
+
+@lru_cache(maxsize=None)
+def sbox_masks() -> np.ndarray:
+    return sbox_outputs()[..., np.newaxis]
+
+
+# Evaluates the 8 S-boxes on x of shape (8, 6, W), returns (8, 4, W)
+def substitute(x: np.ndarray) -> np.ndarray:
+    literals = np.stack((~x, x), axis=2)
+    # minterms[:, m] is set where the input bits of the S-box equal m, the
+    # first input bit being the most significant bit of m
+    minterms = literals[:, 0]
+    for bit in range(1, 6):
+        minterms = minterms[:, :, np.newaxis] & literals[:, bit, np.newaxis]
+        minterms = minterms.reshape(8, -1, x.shape[-1])
+    selected = np.where(sbox_masks(), minterms[:, np.newaxis], np.uint64(0))
+    return np.bitwise_xor.reduce(selected, axis=2)
+
+
+def subkey_masks(key: bytes) -> np.ndarray:
+    subkeys = des.generate_subkeys(des.hex_to_bin(int.from_bytes(key, "big")))
+    return np.array(subkeys, dtype=np.uint64)[..., np.newaxis] * ALL_ONES
+
+
+def to_planes(blocks: np.ndarray) -> np.ndarray:
+    n = len(blocks)
+    padded = np.zeros((-(-n // 64) * 64, BLOCK_SIZE), dtype=np.uint8)
+    padded[:n] = blocks
+    bits = np.ascontiguousarray(np.unpackbits(padded, axis=1).T)
+    return np.packbits(bits, axis=1).view(np.uint64)
+
+
+def from_planes(planes: np.ndarray, n: int) -> np.ndarray:
+    bits = np.unpackbits(np.ascontiguousarray(planes).view(np.uint8), axis=1)
+    return np.packbits(np.ascontiguousarray(bits.T[:n]), axis=1)
+
+
+def crypt_planes(planes: np.ndarray, masks: np.ndarray) -> np.ndarray:
+    planes = planes[ip_index]
+    l, r = planes[:32], planes[32:]
+    for k in masks:
+        x = (r[e_index] ^ k).reshape(8, 6, -1)
+        f = substitute(x).reshape(32, -1)[p_index]
+        l, r = r, l ^ f
+    return np.concatenate((r, l))[ip_inverse_index]
+
+
+def crypt_blocks(blocks: np.ndarray, masks: np.ndarray) -> np.ndarray:
+    blocks = blocks.reshape(-1, BLOCK_SIZE)
+    out = np.empty_like(blocks)
+    for start in range(0, len(blocks), BATCH_BLOCKS):
+        batch = blocks[start : start + BATCH_BLOCKS]
+        planes = crypt_planes(to_planes(batch), masks)
+        out[start : start + len(batch)] = from_planes(planes, len(batch))
+    return out
+
+
+# Encrypts a batch of blocks given as an (N, 8) uint8 array under a single
+# 8-byte key, returns an (N, 8) uint8 array
+def encrypt_blocks(blocks: np.ndarray, key: bytes) -> np.ndarray:
+    return crypt_blocks(blocks, subkey_masks(key))
+
+
+def decrypt_blocks(blocks: np.ndarray, key: bytes) -> np.ndarray:
+    return crypt_blocks(blocks, subkey_masks(key)[::-1])
+
+
+# Checks the example of des.py, run with python -m des_bitslice
+def selftest() -> None:
+    key = bytes.fromhex("133457799bbcdff1")
+    message = np.frombuffer(bytes.fromhex("74616e7573687269"), dtype=np.uint8)
+    ciphertext = encrypt_blocks(message.reshape(1, BLOCK_SIZE), key)
+    assert int.from_bytes(ciphertext.tobytes(), "big") == 0x1C43A6059EAD0F58
+    assert (decrypt_blocks(ciphertext, key) == message).all()
+
+
+if __name__ == "__main__":
+    selftest()
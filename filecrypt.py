@@ -0,0 +1,286 @@
+# Streaming file encryption and decryption with AES (CBC, CTR) and DES/3DES
+#
+# Files are read in large chunks into a reused buffer and passed through a
+# generator pipeline, every stage holds at most one chunk and one partial
+# block, so memory use does not depend on the size of the file.
+#
+# The random IV (CBC) or initial counter block (CTR) is written in front of
+# the ciphertext. CBC uses PKCS#7 padding on the final block, CTR needs no
+# padding.
+#
+# Usage:
+# python -m filecrypt encrypt --cipher aes --mode cbc --key <hex> in out
+# python -m filecrypt decrypt --cipher 3des --mode ctr --key <hex> in out
+import argparse
+import io
+import os
+import sys
+import time
+from contextlib import ExitStack
+from typing import BinaryIO, Iterable, Iterator, Optional
+
+import aes
+import des
+
+# Bytes read from the input file at a time
+CHUNK_SIZE = 1 << 20
+
+# 3DES takes a 16-byte (k1 k2 k1) or 24-byte (k1 k2 k3) key
+CIPHERS = {"aes": aes.AES, "des": des.DES, "3des": des.TripleDES.from_key}
+MODES = ("cbc", "ctr")
+
+
+def xor_bytes(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).to_bytes(len(a), "big")
+
+
+def pad(data: bytes, block_size: int) -> bytes:
+    n = block_size - len(data) % block_size
+    return data + bytes([n]) * n
+
+
+def unpad(data: bytes, block_size: int) -> bytes:
+    n = data[-1] if data else 0
+    if not 0 < n <= block_size or data[-n:] != bytes([n]) * n:
+        raise ValueError("invalid PKCS#7 padding")
+    return data[:-n]
+
+
+# Yields the contents of a file in chunks of chunk_size bytes, read into a
+# single reused buffer
+def read_chunks(f: BinaryIO, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    while True:
+        n = f.readinto(buffer)
+        if not n:
+            return
+        yield bytes(view[:n])
+
+
+# Regroups chunks of any size into chunks whose length is a multiple of
+# block_size. When hold_last is set the last full block is held back, for
+# the final call that has to remove the padding. The last chunk yielded is
+# the (possibly empty) remainder
+def aligned_chunks(
+    chunks: Iterable[bytes], block_size: int, hold_last: bool = False
+) -> Iterator[bytes]:
+    pending = b""
+    for chunk in chunks:
+        pending += chunk
+        n = len(pending) - len(pending) % block_size
+        if hold_last and n == len(pending):
+            n -= block_size
+        if n > 0:
+            yield pending[:n]
+            pending = pending[n:]
+    yield pending
+
+
+def cbc_encrypt(cipher, iv: bytes, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    size = cipher.block_size
+    prev = iv
+    for chunk, is_last in with_last(aligned_chunks(chunks, size)):
+        if is_last:
+            chunk = pad(chunk, size)
+        out = []
+        for i in range(0, len(chunk), size):
+            prev = cipher.encrypt_block(xor_bytes(chunk[i : i + size], prev))
+            out.append(prev)
+        yield b"".join(out)
+
+
+def cbc_decrypt(cipher, iv: bytes, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    size = cipher.block_size
+    prev = iv
+    for chunk, is_last in with_last(aligned_chunks(chunks, size, hold_last=True)):
+        if is_last and len(chunk) != size:
+            raise ValueError("ciphertext is not a multiple of the block size")
+        out = []
+        for i in range(0, len(chunk), size):
+            block = chunk[i : i + size]
+            out.append(xor_bytes(cipher.decrypt_block(block), prev))
+            prev = block
+        data = b"".join(out)
+        yield unpad(data, size) if is_last else data
+
+
+# CTR mode is the same operation for encryption and decryption, the counter
+# is the whole block as a big-endian integer
+def ctr_crypt(cipher, counter: bytes, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    size = cipher.block_size
+    value = int.from_bytes(counter, "big")
+    modulus = 1 << (8 * size)
+    for chunk in aligned_chunks(chunks, size):
+        n = -(-len(chunk) // size)
+        keystream = b"".join(
+            cipher.encrypt_block(((value + i) % modulus).to_bytes(size, "big"))
+            for i in range(n)
+        )
+        value += n
+        yield xor_bytes(chunk, keystream[: len(chunk)])
+
+
+def with_last(items: Iterable[bytes]) -> Iterator[tuple[bytes, bool]]:
+    iterator = iter(items)
+    prev = next(iterator)
+    for item in iterator:
+        yield prev, False
+        prev = item
+    yield prev, True
+
+
+# Encrypts or decrypts src into dst, returns the number of bytes read from
+# src, which includes the IV on decryption but not the IV written on
+# encryption
+def crypt_stream(
+    src: BinaryIO,
+    dst: BinaryIO,
+    cipher_name: str,
+    mode: str,
+    key: bytes,
+    decrypt: bool = False,
+    iv: Optional[bytes] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    if cipher_name not in CIPHERS:
+        raise ValueError(f"unknown cipher: {cipher_name}")
+    if mode not in MODES:
+        raise ValueError(f"unknown mode: {mode}")
+    cipher = CIPHERS[cipher_name](key)
+    size = cipher.block_size
+    if decrypt:
+        iv = src.read(size)
+        if len(iv) != size:
+            raise ValueError("input is too short to contain an IV")
+    else:
+        iv = iv if iv is not None else os.urandom(size)
+        if len(iv) != size:
+            raise ValueError(f"IV must be {size} bytes")
+        dst.write(iv)
+
+    total = size if decrypt else 0
+
+    def counted(chunks: Iterator[bytes]) -> Iterator[bytes]:
+        nonlocal total
+        for chunk in chunks:
+            total += len(chunk)
+            yield chunk
+
+    chunks = counted(read_chunks(src, chunk_size))
+    if mode == "ctr":
+        output = ctr_crypt(cipher, iv, chunks)
+    elif decrypt:
+        output = cbc_decrypt(cipher, iv, chunks)
+    else:
+        output = cbc_encrypt(cipher, iv, chunks)
+    for chunk in output:
+        dst.write(chunk)
+    return total
+
+
+def encrypt_file(
+    src_path: str, dst_path: str, cipher_name: str, mode: str, key: bytes, **kwargs
+) -> int:
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        return crypt_stream(src, dst, cipher_name, mode, key, **kwargs)
+
+
+def decrypt_file(
+    src_path: str, dst_path: str, cipher_name: str, mode: str, key: bytes, **kwargs
+) -> int:
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        return crypt_stream(src, dst, cipher_name, mode, key, decrypt=True, **kwargs)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m filecrypt")
+    parser.add_argument("operation", choices=("encrypt", "decrypt"))
+    parser.add_argument("input", help="input file, - for stdin")
+    parser.add_argument("output", help="output file, - for stdout")
+    parser.add_argument("--cipher", choices=tuple(CIPHERS), default="aes")
+    parser.add_argument("--mode", choices=MODES, default="cbc")
+    parser.add_argument("--key", required=True, help="key in hex")
+    parser.add_argument("--iv", help="IV or initial counter in hex (encryption)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    try:
+        key = bytes.fromhex(args.key)
+        iv = bytes.fromhex(args.iv) if args.iv else None
+        # The key and IV are checked before the output file is truncated
+        block_size = CIPHERS[args.cipher](key).block_size
+        if iv is not None and len(iv) != block_size:
+            raise ValueError(f"IV must be {block_size} bytes")
+        with ExitStack() as stack:
+            if args.input == "-":
+                src = sys.stdin.buffer
+            else:
+                src = stack.enter_context(open(args.input, "rb"))
+            if args.output == "-":
+                dst = sys.stdout.buffer
+            else:
+                dst = stack.enter_context(open(args.output, "wb"))
+            total = crypt_stream(
+                src,
+                dst,
+                args.cipher,
+                args.mode,
+                key,
+                decrypt=args.operation == "decrypt",
+                iv=iv,
+                chunk_size=args.chunk_size,
+            )
+    except (OSError, ValueError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    elapsed = time.perf_counter() - start
+    print(
+        f"{total} bytes in {elapsed:.3f} s ({total / elapsed:.0f} bytes/s)",
+        file=sys.stderr,
+    )
+    return 0
+
+
+# Round trips through crypt_stream for every cipher and mode, with chunks
+# that split blocks, and the first block of SP 800-38A F.2.1 (CBC-AES128)
+# and F.5.1 (CTR-AES128)
+def selftest() -> None:
+    keys = {"aes": bytes(range(16)), "des": bytes(range(8)), "3des": bytes(range(24))}
+    for cipher_name, key in keys.items():
+        for mode in MODES:
+            for length in (0, 1, 8, 16, 45):
+                data = bytes(range(length))
+                encrypted = io.BytesIO()
+                total = crypt_stream(
+                    io.BytesIO(data), encrypted, cipher_name, mode, key, chunk_size=7
+                )
+                assert total == length
+                decrypted = io.BytesIO()
+                total = crypt_stream(
+                    io.BytesIO(encrypted.getvalue()),
+                    decrypted,
+                    cipher_name,
+                    mode,
+                    key,
+                    decrypt=True,
+                    chunk_size=5,
+                )
+                assert total == len(encrypted.getvalue())
+                assert decrypted.getvalue() == data
+
+    key = bytes.fromhex("2b7e151628aed2a6abf7158809cf4f3c")
+    plaintext = bytes.fromhex("6bc1bee22e409f96e93d7e117393172a")
+    for mode, iv, want in (
+        ("cbc", "000102030405060708090a0b0c0d0e0f", "7649abac8119b246cee98e9b12e9197d"),
+        ("ctr", "f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff", "874d6191b620e3261bef6864990db6ce"),
+    ):
+        encrypted = io.BytesIO()
+        iv = bytes.fromhex(iv)
+        crypt_stream(io.BytesIO(plaintext), encrypted, "aes", mode, key, iv=iv)
+        assert encrypted.getvalue()[:32] == iv + bytes.fromhex(want)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
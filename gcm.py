@@ -0,0 +1,312 @@
+# AES in Galois/Counter Mode (GCM)
+# Reference:
+# https://nvlpubs.nist.gov/nistpubs/Legacy/SP/nistspecialpublication800-38d.pdf
+#
+# GCM encrypts with AES in counter mode and authenticates the additional data
+# and the ciphertext with GHASH, a polynomial hash over GF(2^128) keyed by
+# H = CIPH(K, 0^128).
+#
+# GHASH multiplies by the fixed H once per block. Since multiplication by H
+# is linear, the product X•H is the XOR of the products of the 16 bytes of X
+# (each at its own position) with H. Those are precomputed once per key into
+# 16 tables of 256 entries (Shoup's 8-bit tables), so that a multiplication
+# takes 16 lookups and XORs instead of 128 shift and conditional XOR steps.
+import hmac
+import struct
+import time
+from functools import lru_cache
+from typing import Optional
+
+import aes
+
+BLOCK_SIZE = 16
+MASK_32 = 0xFFFFFFFF
+# x^128 + x^7 + x^2 + x + 1, in the bit-reflected representation of GCM
+R = 0xE1 << 120
+
+lengths_block = struct.Struct(">QQ")
+
+
+class InvalidTag(ValueError):
+    pass
+
+
+# Bits of a block are numbered from the leftmost bit, bit i being the
+# coefficient of x^i. Reading the block as a big-endian integer, multiplying
+# by x is therefore a right shift, reduced by R when x^127 is shifted out
+def gf_mul_x(v: int) -> int:
+    return (v >> 1) ^ R if v & 1 else v >> 1
+
+
+# Bit-serial multiplication in GF(2^128), from Algorithm 1 of SP 800-38D
+def gf_mul_128(x: int, y: int) -> int:
+    z = 0
+    for i in range(127, -1, -1):
+        if x >> i & 1:
+            z ^= y
+        y = gf_mul_x(y)
+    return z
+
+
+# tables[i][b] is the product of H with the block that has byte b at
+# position i and zeros everywhere else
+def ghash_tables(h: int) -> tuple[tuple[int, ...], ...]:
+    # powers[k] = H•x^k, the product of H with the block where only bit k
+    # is set
+    powers = [h]
+    for _ in range(127):
+        powers.append(gf_mul_x(powers[-1]))
+    tables = []
+    for i in range(BLOCK_SIZE):
+        table = [0] * 256
+        for b in range(1, 256):
+            # Split off the lowest set bit, which is bit 7 - j of the byte
+            # and bit 8i + j of the block
+            low = b & -b
+            table[b] = table[b ^ low] ^ powers[8 * i + 7 - low.bit_length() + 1]
+        tables.append(tuple(table))
+    return tuple(tables)
+
+
+# The hash subkey and its tables are cached per key, like the key schedule
+@lru_cache(maxsize=256)
+def gcm_key(key: bytes) -> tuple[aes.AES, tuple[tuple[int, ...], ...]]:
+    cipher = aes.AES(key)
+    h = int.from_bytes(cipher.encrypt_block(bytes(BLOCK_SIZE)), "big")
+    return cipher, ghash_tables(h)
+
+
+class GHASH:
+    def __init__(self, tables: tuple[tuple[int, ...], ...]):
+        self.tables = tables
+        self.y = 0
+        self.pending = b""
+
+    # fmt: off
+    def absorb(self, data: bytes) -> None:
+        t0, t1, t2, t3, t4, t5, t6, t7, t8, t9, t10, t11, t12, t13, t14, t15 = self.tables
+        y = self.y
+        for i in range(0, len(data), BLOCK_SIZE):
+            b = (y ^ int.from_bytes(data[i : i + BLOCK_SIZE], "big")).to_bytes(16, "big")
+            y = (
+                t0[b[0]] ^ t1[b[1]] ^ t2[b[2]] ^ t3[b[3]] ^ t4[b[4]] ^ t5[b[5]] ^ t6[b[6]] ^ t7[b[7]]
+                ^ t8[b[8]] ^ t9[b[9]] ^ t10[b[10]] ^ t11[b[11]] ^ t12[b[12]] ^ t13[b[13]] ^ t14[b[14]] ^ t15[b[15]]
+            )
+        self.y = y
+    # fmt: on
+
+    def update(self, data: bytes) -> None:
+        data = self.pending + bytes(data)
+        n = len(data) - len(data) % BLOCK_SIZE
+        self.absorb(data[:n])
+        self.pending = data[n:]
+
+    # Completes the current partial block with zeros
+    def pad(self) -> None:
+        if self.pending:
+            self.absorb(self.pending.ljust(BLOCK_SIZE, b"\x00"))
+            self.pending = b""
+
+    def digest(self) -> int:
+        self.pad()
+        return self.y
+
+
+# Counter mode with a 32-bit counter in the last 4 bytes of the counter block,
+# the keystream bytes of a partial block are kept for the next call
+class GCTR:
+    def __init__(self, cipher: aes.AES, counter_block: bytes):
+        self.nr, self.rk = cipher.nr, cipher.rk
+        self.prefix = counter_block[:12]
+        self.counter = int.from_bytes(counter_block[12:], "big")
+        self.leftover = b""
+
+    def keystream(self, n: int) -> bytes:
+        out = self.leftover
+        words = aes.block_words
+        prefix = words.unpack(self.prefix + bytes(4))[:3]
+        blocks = []
+        for _ in range(-(-(n - len(out)) // BLOCK_SIZE)):
+            blocks.append(
+                words.pack(*aes.encrypt_words(*prefix, self.counter, self.nr, self.rk))
+            )
+            self.counter = (self.counter + 1) & MASK_32
+        out += b"".join(blocks)
+        self.leftover = out[n:]
+        return out[:n]
+
+    def update(self, data: bytes) -> bytes:
+        keystream = self.keystream(len(data))
+        return (
+            int.from_bytes(data, "big") ^ int.from_bytes(keystream, "big")
+        ).to_bytes(len(data), "big")
+
+
+# Incremental GCM encryption or decryption. All the additional data has to
+# be passed to update_aad() before the first call to update()
+class GCMContext:
+    def __init__(self, key: bytes, iv: bytes, decrypt: bool, tag_length: int = 16):
+        if not iv:
+            raise ValueError("IV must not be empty")
+        if not 4 <= tag_length <= 16:
+            raise ValueError("tag length must be between 4 and 16 bytes")
+        self.cipher, tables = gcm_key(bytes(key))
+        self.decrypt = decrypt
+        self.tag_length = tag_length
+        # The pre-counter block J0 is IV || 0^31 || 1 for a 96-bit IV,
+        # otherwise it is derived from the IV with GHASH
+        if len(iv) == 12:
+            j0 = bytes(iv) + b"\x00\x00\x00\x01"
+        else:
+            ghash = GHASH(tables)
+            ghash.update(iv)
+            ghash.pad()
+            ghash.update(lengths_block.pack(0, 8 * len(iv)))
+            j0 = ghash.digest().to_bytes(16, "big")
+        self.tag_mask = self.cipher.encrypt_block(j0)
+        # The payload is encrypted starting from inc32(J0)
+        counter = (int.from_bytes(j0[12:], "big") + 1) & MASK_32
+        self.gctr = GCTR(self.cipher, j0[:12] + counter.to_bytes(4, "big"))
+        self.ghash = GHASH(tables)
+        self.aad_length = 0
+        self.data_length = 0
+        self.aad_done = False
+        self.tag: Optional[bytes] = None
+
+    def update_aad(self, data: bytes) -> None:
+        if self.aad_done:
+            raise ValueError("additional data must be passed before the payload")
+        self.ghash.update(data)
+        self.aad_length += len(data)
+
+    def update(self, data: bytes) -> bytes:
+        if self.tag is not None:
+            raise ValueError("context is already finalized")
+        if not self.aad_done:
+            self.ghash.pad()
+            self.aad_done = True
+        self.data_length += len(data)
+        if self.decrypt:
+            self.ghash.update(data)
+            return self.gctr.update(data)
+        out = self.gctr.update(data)
+        self.ghash.update(out)
+        return out
+
+    def compute_tag(self) -> bytes:
+        self.ghash.pad()
+        self.ghash.update(lengths_block.pack(8 * self.aad_length, 8 * self.data_length))
+        s = self.ghash.digest() ^ int.from_bytes(self.tag_mask, "big")
+        return s.to_bytes(16, "big")[: self.tag_length]
+
+    # Returns the tag after encryption. After decryption the expected tag has
+    # to be passed, InvalidTag is raised if it does not match
+    def finalize(self, tag: Optional[bytes] = None) -> bytes:
+        if self.tag is None:
+            self.tag = self.compute_tag()
+        if self.decrypt:
+            if tag is None or not hmac.compare_digest(self.tag, tag):
+                raise InvalidTag("authentication tag does not match")
+        return self.tag
+
+
+def encrypt(
+    key: bytes, iv: bytes, plaintext: bytes, aad: bytes = b"", tag_length: int = 16
+) -> tuple[bytes, bytes]:
+    ctx = GCMContext(key, iv, decrypt=False, tag_length=tag_length)
+    ctx.update_aad(aad)
+    ciphertext = ctx.update(plaintext)
+    return ciphertext, ctx.finalize()
+
+
+# Raises InvalidTag without returning any plaintext if authentication fails
+def decrypt(
+    key: bytes, iv: bytes, ciphertext: bytes, tag: bytes, aad: bytes = b""
+) -> bytes:
+    ctx = GCMContext(key, iv, decrypt=True, tag_length=len(tag))
+    ctx.update_aad(aad)
+    plaintext = ctx.update(ciphertext)
+    ctx.finalize(tag)
+    return plaintext
+
+
+# Throughput of GHASH and of the CTR keystream measured separately, in MB/s
+def benchmark(size: int = 1 << 20) -> None:
+    key = bytes(range(16))
+    cipher, tables = gcm_key(key)
+    data = bytes(size)
+    start = time.perf_counter()
+    GHASH(tables).update(data)
+    ghash_rate = size / (time.perf_counter() - start) / 1e6
+    start = time.perf_counter()
+    GCTR(cipher, bytes(16)).update(data)
+    ctr_rate = size / (time.perf_counter() - start) / 1e6
+    print(f"GHASH: {ghash_rate:.2f} MB/s")
+    print(f"CTR keystream: {ctr_rate:.2f} MB/s")
+
+
+# Test cases from the GCM specification submitted to NIST (McGrew and Viega),
+# as (key, iv, plaintext, aad, ciphertext, tag)
+# fmt: off
+test_vectors = (
+    (
+        "00000000000000000000000000000000", "000000000000000000000000", "", "", "",
+        "58e2fccefa7e3061367f1d57a4e7455a",
+    ),
+    (
+        "00000000000000000000000000000000", "000000000000000000000000",
+        "00000000000000000000000000000000", "", "0388dace60b6a392f328c2b971b2fe78",
+        "ab6e47d42cec13bdf53a67b21257bddf",
+    ),
+    (
+        "feffe9928665731c6d6a8f9467308308", "cafebabefacedbaddecaf888",
+        "d9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a721c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b391aafd255",
+        "",
+        "42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091473f5985",
+        "4d5c2af327cd64a62cf35abd2ba6fab4",
+    ),
+    (
+        "feffe9928665731c6d6a8f9467308308", "cafebabefacedbaddecaf888",
+        "d9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a721c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b39",
+        "feedfacedeadbeeffeedfacedeadbeefabaddad2",
+        "42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091",
+        "5bc94fbc3221a5db94fae95ae7121a47",
+    ),
+    (
+        "feffe9928665731c6d6a8f9467308308",
+        "9313225df88406e555909c5aff5269aa6a7a9538534f7da1e4c303d2a318a728c3c0c95156809539fcf0e2429a6b525416aedbf5a0de6a57a637b39b",
+        "d9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a721c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b39",
+        "feedfacedeadbeeffeedfacedeadbeefabaddad2",
+        "8ce24998625615b603a033aca13fb894be9112a5c3a211a8ba262a3cca7e2ca701e4a9a4fba43c90ccdcb281d48c7c6fd62875d2aca417034c34aee5",
+        "619cc5aefffe0bfa462af43c1699d050",
+    ),
+    (
+        "feffe9928665731c6d6a8f9467308308feffe9928665731c6d6a8f9467308308",
+        "cafebabefacedbaddecaf888",
+        "d9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a721c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b39",
+        "feedfacedeadbeeffeedfacedeadbeefabaddad2",
+        "522dc1f099567d07f47f37a32a84427d643a8cdcbfe5c0c97598a2bd2555d1aa8cb08e48590dbb3da7b08b1056828838c5f61e6393ba7a0abcc9f662",
+        "76fc6ece0f4e1768cddf8853bb2d551b",
+    ),
+)
+# fmt: on
+
+
+# Checks the test vectors above, run with python -m gcm
+def selftest() -> None:
+    for vector in test_vectors:
+        key, iv, plaintext, aad, ciphertext, tag = map(bytes.fromhex, vector)
+        assert encrypt(key, iv, plaintext, aad) == (ciphertext, tag)
+        assert decrypt(key, iv, ciphertext, tag, aad) == plaintext
+
+    # The table-driven GHASH agrees with bit-serial multiplication by H
+    _, tables = gcm_key(bytes(16))
+    h = int.from_bytes(aes.AES(bytes(16)).encrypt_block(bytes(16)), "big")
+    ghash = GHASH(tables)
+    ghash.update(bytes(range(16)))
+    assert ghash.digest() == gf_mul_128(int.from_bytes(bytes(range(16)), "big"), h)
+
+
+if __name__ == "__main__":
+    selftest()
+    benchmark()
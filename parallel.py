@@ -0,0 +1,324 @@
+# Multi-core bulk AES for the modes whose blocks are independent of each
+# other: ECB encryption and decryption, CTR, and CBC decryption (every
+# plaintext block only depends on 2 ciphertext blocks).
+#
+# The buffer is copied once into shared memory and split into block-aligned
+# chunks. Worker processes attach to the shared memory by name and write
+# their results in place, so only the chunk offsets are pickled. The workers
+# are persistent and keep the expanded key schedule in their key schedule
+# cache between calls.
+#
+# run() returns a new bytes object, which holds the payload three times in
+# the parent at its peak (input, shared memory, output). The *_into methods
+# write the result into a buffer of the caller, dst may be src. Data read
+# directly into a SharedBuffer is processed in place with run_shared(),
+# without any copy:
+#
+# with ParallelAES(key) as cipher, SharedBuffer(size) as buffer:
+#     f.readinto(buffer.buf)
+#     cipher.run_shared("ctr", counter, buffer)
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Optional
+
+import aes
+from filecrypt import xor_bytes
+
+BLOCK_SIZE = 16
+# Default number of bytes per task sent to a worker
+CHUNK_SIZE = 1 << 20
+# Buffers smaller than this are processed in the calling process
+THRESHOLD = 1 << 18
+
+MODES = ("ecb-encrypt", "ecb-decrypt", "ctr", "cbc-decrypt")
+
+
+# Processes a block-aligned chunk. For CTR the iv is the counter block of
+# the first block of the chunk, for CBC decryption it is the ciphertext
+# block preceding the chunk
+def crypt_chunk(mode: str, key: bytes, iv: Optional[bytes], data: bytes) -> bytes:
+    nr, rk, dk = aes.key_schedule_cache.get(key)
+    words = aes.block_words
+    if mode == "ecb-encrypt":
+        return b"".join(
+            words.pack(*aes.encrypt_words(*block, nr, rk))
+            for block in words.iter_unpack(data)
+        )
+    if mode == "ecb-decrypt":
+        return b"".join(
+            words.pack(*aes.decrypt_words(*block, nr, dk))
+            for block in words.iter_unpack(data)
+        )
+    if mode == "ctr":
+        counter = int.from_bytes(iv, "big")
+        keystream = b"".join(
+            words.pack(
+                *aes.encrypt_words(
+                    *words.unpack(((counter + i) % (1 << 128)).to_bytes(16, "big")),
+                    nr,
+                    rk,
+                )
+            )
+            for i in range(-(-len(data) // BLOCK_SIZE))
+        )
+        return xor_bytes(data, keystream[: len(data)])
+    if mode == "cbc-decrypt":
+        decrypted = b"".join(
+            words.pack(*aes.decrypt_words(*block, nr, dk))
+            for block in words.iter_unpack(data)
+        )
+        return xor_bytes(decrypted, iv + data[:-BLOCK_SIZE])
+    raise ValueError(f"unknown mode: {mode}")
+
+
+# Runs in a worker process, attaches to the shared memory block and
+# replaces data[offset : offset + length] with its result
+def crypt_shared(
+    name: str, mode: str, key: bytes, iv: Optional[bytes], offset: int, length: int
+) -> None:
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        # The view is released before close(), also when crypt_chunk raises
+        with shm.buf[offset : offset + length] as chunk:
+            chunk[:] = crypt_chunk(mode, key, iv, bytes(chunk))
+    finally:
+        shm.close()
+
+
+# Shared memory the workers process in place. buf is a memoryview of
+# exactly size bytes, views of it taken by the caller must be released
+# before close()
+class SharedBuffer:
+    def __init__(self, size: int):
+        if size < 0:
+            raise ValueError("size must not be negative")
+        # SharedMemory does not accept a size of 0
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.buf = self.shm.buf[:size]
+
+    def __len__(self) -> int:
+        return len(self.buf)
+
+    def __enter__(self) -> "SharedBuffer":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.buf is not None:
+            self.buf.release()
+            self.buf = None
+            self.shm.close()
+            self.shm.unlink()
+
+
+class ParallelAES:
+    def __init__(
+        self,
+        key: bytes,
+        workers: Optional[int] = None,
+        chunk_size: int = CHUNK_SIZE,
+        threshold: int = THRESHOLD,
+    ):
+        if chunk_size <= 0 or chunk_size % BLOCK_SIZE:
+            raise ValueError("chunk_size must be a positive multiple of 16")
+        self.key = bytes(key)
+        # Validates the key and warms the cache of the calling process
+        aes.key_schedule_cache.get(self.key)
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.threshold = threshold
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def __enter__(self) -> "ParallelAES":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    # The pool is started on first use, every worker expands the key once
+    # and reuses it for all later tasks
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.workers,
+                initializer=aes.key_schedule_cache.get,
+                initargs=(self.key,),
+            )
+        return self._pool
+
+    def encrypt_ecb(self, data: bytes) -> bytes:
+        return self.run("ecb-encrypt", None, data)
+
+    def decrypt_ecb(self, data: bytes) -> bytes:
+        return self.run("ecb-decrypt", None, data)
+
+    # Encryption and decryption are the same operation in CTR mode
+    def crypt_ctr(self, counter: bytes, data: bytes) -> bytes:
+        return self.run("ctr", counter, data)
+
+    def decrypt_cbc(self, iv: bytes, data: bytes) -> bytes:
+        return self.run("cbc-decrypt", iv, data)
+
+    def encrypt_ecb_into(self, dst, src) -> int:
+        return self.run_into("ecb-encrypt", None, dst, src)
+
+    def decrypt_ecb_into(self, dst, src) -> int:
+        return self.run_into("ecb-decrypt", None, dst, src)
+
+    def crypt_ctr_into(self, counter: bytes, dst, src) -> int:
+        return self.run_into("ctr", counter, dst, src)
+
+    def decrypt_cbc_into(self, iv: bytes, dst, src) -> int:
+        return self.run_into("cbc-decrypt", iv, dst, src)
+
+    def check(self, mode: str, iv: Optional[bytes], length: int) -> None:
+        if mode not in MODES:
+            raise ValueError(f"unknown mode: {mode}")
+        if mode != "ctr" and length % BLOCK_SIZE:
+            raise ValueError("data length must be a multiple of 16 bytes")
+        if mode in ("ctr", "cbc-decrypt"):
+            if iv is None or len(iv) != BLOCK_SIZE:
+                raise ValueError(f"{mode} needs a 16-byte iv")
+        elif iv is not None and len(iv) != BLOCK_SIZE:
+            raise ValueError("iv must be 16 bytes")
+
+    def run(self, mode: str, iv: Optional[bytes], data: bytes) -> bytes:
+        self.check(mode, iv, len(data))
+        if not data or len(data) < self.threshold:
+            return crypt_chunk(mode, self.key, iv, bytes(data))
+        with SharedBuffer(len(data)) as buffer:
+            buffer.buf[:] = memoryview(data).cast("B")
+            self.dispatch(mode, iv, buffer)
+            return bytes(buffer.buf)
+
+    # Writes the result for src into dst, which may be src itself, and
+    # returns the number of bytes processed. Only the shared memory is
+    # allocated besides the buffers of the caller
+    def run_into(self, mode: str, iv: Optional[bytes], dst, src) -> int:
+        with memoryview(src) as src_mv, memoryview(dst) as dst_mv:
+            if dst_mv.readonly:
+                raise TypeError("dst must be a writable buffer")
+            with src_mv.cast("B") as src_view, dst_mv.cast("B") as dst_view:
+                n = len(src_view)
+                self.check(mode, iv, n)
+                if len(dst_view) < n:
+                    raise ValueError("dst is smaller than src")
+                if n < self.threshold:
+                    dst_view[:n] = crypt_chunk(mode, self.key, iv, bytes(src_view))
+                    return n
+                with SharedBuffer(n) as buffer:
+                    buffer.buf[:] = src_view
+                    self.dispatch(mode, iv, buffer)
+                    dst_view[:n] = buffer.buf
+        return n
+
+    # Processes the contents of buffer in place
+    def run_shared(self, mode: str, iv: Optional[bytes], buffer: SharedBuffer) -> int:
+        n = len(buffer)
+        self.check(mode, iv, n)
+        if n < self.threshold:
+            buffer.buf[:] = crypt_chunk(mode, self.key, iv, bytes(buffer.buf))
+        else:
+            self.dispatch(mode, iv, buffer)
+        return n
+
+    def dispatch(self, mode: str, iv: Optional[bytes], buffer: SharedBuffer) -> None:
+        n = len(buffer)
+        offsets = range(0, n, self.chunk_size)
+        # All the ivs are read before any worker writes to the buffer
+        ivs = [self.chunk_iv(mode, iv, buffer.buf, offset) for offset in offsets]
+        futures = [
+            self.pool().submit(
+                crypt_shared,
+                buffer.shm.name,
+                mode,
+                self.key,
+                chunk_iv,
+                offset,
+                min(self.chunk_size, n - offset),
+            )
+            for offset, chunk_iv in zip(offsets, ivs)
+        ]
+        for future in futures:
+            future.result()
+
+    # The iv of a chunk is derived from the input before any worker starts
+    # writing to the shared buffer
+    def chunk_iv(
+        self, mode: str, iv: Optional[bytes], data: memoryview, offset: int
+    ) -> Optional[bytes]:
+        if mode == "ctr":
+            counter = int.from_bytes(iv, "big") + offset // BLOCK_SIZE
+            return (counter % (1 << 128)).to_bytes(16, "big")
+        if mode == "cbc-decrypt":
+            return iv if offset == 0 else bytes(data[offset - BLOCK_SIZE : offset])
+        return None
+
+
+# Checks every mode against aes.AES, in the calling process and in the
+# workers, with chunks that do not divide the data evenly
+def selftest() -> None:
+    key = bytes(range(16))
+    iv = bytes.fromhex("f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff")
+    data = bytes(range(256)) * 5
+    cipher = aes.AES(key)
+    blocks = [data[i : i + BLOCK_SIZE] for i in range(0, len(data), BLOCK_SIZE)]
+    ecb = b"".join(cipher.encrypt_block(block) for block in blocks)
+    keystream = b"".join(
+        cipher.encrypt_block(
+            ((int.from_bytes(iv, "big") + i) % (1 << 128)).to_bytes(16, "big")
+        )
+        for i in range(len(blocks))
+    )
+    ctr = xor_bytes(data, keystream)
+    previous = [iv] + blocks[:-1]
+    cbc = b"".join(
+        xor_bytes(cipher.decrypt_block(block), prev)
+        for block, prev in zip(blocks, previous)
+    )
+    for threshold in (len(data) + 1, 0):
+        with ParallelAES(key, 2, 3 * BLOCK_SIZE, threshold) as parallel:
+            assert parallel.encrypt_ecb(data) == ecb
+            assert parallel.decrypt_ecb(ecb) == data
+            assert parallel.crypt_ctr(iv, data) == ctr
+            assert parallel.crypt_ctr(iv, data[:-5]) == ctr[:-5]
+            assert parallel.decrypt_cbc(iv, data) == cbc
+
+            out = bytearray(len(data))
+            assert parallel.encrypt_ecb_into(out, data) == len(data)
+            assert out == ecb
+            parallel.decrypt_ecb_into(out, out)
+            assert out == data
+            parallel.crypt_ctr_into(iv, out, data)
+            assert out == ctr
+            out[:] = data
+            parallel.decrypt_cbc_into(iv, out, out)
+            assert out == cbc
+
+            for mode, bad_iv in (("ctr", None), ("cbc-decrypt", bytes(8))):
+                try:
+                    parallel.run(mode, bad_iv, data)
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError(f"{mode} accepted a bad iv")
+
+            with SharedBuffer(len(data)) as buffer:
+                buffer.buf[:] = data
+                parallel.run_shared("cbc-decrypt", iv, buffer)
+                assert buffer.buf == cbc
+                buffer.buf[:] = data
+                parallel.run_shared("ctr", iv, buffer)
+                assert buffer.buf == ctr
+
+
+if __name__ == "__main__":
+    selftest()
@@ -0,0 +1,170 @@
+# Per-stage profiling of the reference AES and DES functions
+#
+# The round functions of aes.py and des.py call each other through their
+# module globals, so a stage is instrumented by replacing the function in
+# its module with a wrapper that counts calls and time, and uninstrumented
+# by putting the original function object back. When profiling is disabled
+# the modules hold their original functions and the cost is zero, no flag is
+# checked on the hot path.
+#
+# Times are inclusive: feistel() includes the permute() and substitute()
+# calls it makes. Allocated bytes are only collected with memory=True, as the
+# growth of the tracemalloc peak during the call. tracemalloc slows down
+# every allocation and its peak is global, so a nested stage resets the peak
+# seen by the stage calling it, which makes the outer value a lower bound.
+#
+# Only calls made through the module attribute are seen, a reference taken
+# before enable() (from aes import sub_bytes) keeps calling the original.
+#
+# Usage:
+# profiling.enable()
+# aes.cipher(block, nr, w)
+# print(profiling.to_prometheus())
+# profiling.disable()
+import functools
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional
+
+import aes
+import des
+
+# Stage name -> (module, function name)
+STAGES = {
+    "aes.key_expansion": (aes, "key_expansion"),
+    "aes.add_round_key": (aes, "add_round_key"),
+    "aes.sub_bytes": (aes, "sub_bytes"),
+    "aes.shift_rows": (aes, "shift_rows"),
+    "aes.mix_columns": (aes, "mix_columns"),
+    "aes.gf_mul": (aes, "gf_mul"),
+    "aes.inv_sub_bytes": (aes, "inv_sub_bytes"),
+    "aes.inv_shift_rows": (aes, "inv_shift_rows"),
+    "aes.inv_mix_columns": (aes, "inv_mix_columns"),
+    "des.generate_subkeys": (des, "generate_subkeys"),
+    "des.permute": (des, "permute"),
+    "des.substitute": (des, "substitute"),
+    "des.feistel": (des, "feistel"),
+}
+
+# Stage name -> [calls, nanoseconds, allocated bytes]
+stats: dict[str, list[int]] = {name: [0, 0, 0] for name in STAGES}
+# Original functions of the instrumented stages
+originals: dict[str, Callable] = {}
+# tracemalloc was started by enable() and is stopped by disable()
+started_tracemalloc = False
+
+
+def timed(func: Callable, counters: list[int]) -> Callable:
+    clock = time.perf_counter_ns
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            counters[1] += clock() - start
+            counters[0] += 1
+
+    return wrapper
+
+
+def timed_memory(func: Callable, counters: list[int]) -> Callable:
+    clock = time.perf_counter_ns
+    traced = tracemalloc.get_traced_memory
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        tracemalloc.reset_peak()
+        before = traced()[0]
+        start = clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            counters[1] += clock() - start
+            counters[0] += 1
+            counters[2] += max(0, traced()[1] - before)
+
+    return wrapper
+
+
+def enable(stages: Optional[Iterable[str]] = None, memory: bool = False) -> None:
+    global started_tracemalloc
+    names = list(STAGES if stages is None else stages)
+    for name in names:
+        if name not in STAGES:
+            raise ValueError(f"unknown stage: {name}")
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        started_tracemalloc = True
+    wrap = timed_memory if memory else timed
+    for name in names:
+        module, attribute = STAGES[name]
+        if name in originals:
+            # Already instrumented, possibly without memory tracking
+            setattr(module, attribute, originals[name])
+        originals[name] = getattr(module, attribute)
+        setattr(module, attribute, wrap(originals[name], stats[name]))
+
+
+def disable() -> None:
+    global started_tracemalloc
+    for name, func in originals.items():
+        module, attribute = STAGES[name]
+        setattr(module, attribute, func)
+    originals.clear()
+    if started_tracemalloc:
+        tracemalloc.stop()
+        started_tracemalloc = False
+
+
+def enabled() -> bool:
+    return bool(originals)
+
+
+@contextmanager
+def profile(
+    stages: Optional[Iterable[str]] = None, memory: bool = False
+) -> Iterator[None]:
+    enable(stages, memory)
+    try:
+        yield
+    finally:
+        disable()
+
+
+def snapshot() -> dict[str, dict[str, int]]:
+    return {
+        name: {"calls": calls, "ns": ns, "bytes": allocated}
+        for name, (calls, ns, allocated) in stats.items()
+    }
+
+
+def reset() -> None:
+    # The wrappers hold the lists, they are cleared in place
+    for counters in stats.values():
+        counters[:] = [0, 0, 0]
+
+
+def to_json(data: Optional[dict[str, dict[str, int]]] = None) -> str:
+    return json.dumps(snapshot() if data is None else data, indent=2)
+
+
+# Prometheus text exposition format, one counter family per field
+def to_prometheus(data: Optional[dict[str, dict[str, int]]] = None) -> str:
+    data = snapshot() if data is None else data
+    families = (
+        ("cipher_stage_calls_total", "Calls of the stage", "calls"),
+        ("cipher_stage_seconds_total", "Time spent in the stage", "ns"),
+        ("cipher_stage_allocated_bytes_total", "Bytes allocated", "bytes"),
+    )
+    lines = []
+    for metric, help, field in families:
+        lines.append(f"# HELP {metric} {help}")
+        lines.append(f"# TYPE {metric} counter")
+        for name, values in data.items():
+            value = values[field] / 1e9 if field == "ns" else values[field]
+            lines.append(f'{metric}{{stage="{name}"}} {value}')
+    return "\n".join(lines) + "\n"